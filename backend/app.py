@@ -1,32 +1,76 @@
+from __future__ import annotations
+
 import os
+import re
 from dotenv import load_dotenv
+import importlib
 import json
 import pprint
 import requests
+import gzip
+import hashlib
+import heapq
+import itertools
+import random
+import sys
+import threading
+import time
+import warnings
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
 from typing import List, Dict
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, Response, make_response
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+from flask import Blueprint, Flask, request, jsonify, Response, make_response, g, has_request_context, \
+    current_app, has_app_context, stream_with_context
 from flask_cors import CORS
-from pymongo import MongoClient
-import yfinance as yf
-import pandas as pd
-import numpy as np
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import click
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
 from operator import itemgetter
 # from openai import OpenAI
-import cohere
 
-app = Flask(__name__)
+class LazyModule:
+    """Stand-in for a heavy module that imports it the first time one of its attributes is used"""
 
-CORS(app, supports_credentials=True)
+    def __init__(self, name):
+        self._name = name
+        self._module = None
 
-load_dotenv(dotenv_path=".env")
+    def _import(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        # Keep the resolved attribute so later lookups skip __getattr__ (np.isnan in per-element loops)
+        value = getattr(self._import(), attr)
+        setattr(self, attr, value)
+        return value
+
+# Heavy modules are only imported once a request (or warmup()) needs them
+yf = LazyModule('yfinance')
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+cohere = LazyModule('cohere')
 
-mongo_client = MongoClient(os.environ.get('MONGODB_URI'))
-db = mongo_client['test']
+optional_modules = {}
+
+def optional_module(name):
+    """Import an optional dependency such as a response encoder, or return None if it is not installed"""
+    if name not in optional_modules:
+        try:
+            optional_modules[name] = importlib.import_module(name)
+        except ImportError:
+            optional_modules[name] = None
+    return optional_modules[name]
+
+api = Blueprint('api', __name__, cli_group=None)
+
+load_dotenv(dotenv_path=".env")
 
 # openai_client = OpenAI(api_key=os.environ.get('OPENAI_KEY'))
-cohere_client = cohere.ClientV2(api_key=os.environ.get('COHERE_KEY'))
 
 documents = [
     {
@@ -194,19 +238,20 @@ documents = [
 ]
 
 
-@app.route('/')
+@api.route('/')
 def home():
     return "Hello, Flask!"
 
-@app.route('/api/test/users', methods=['POST'])
+@api.route('/api/test/users', methods=['POST'])
 def test_new_user():
     data = request.json
     print(data)
 
-    db['users'].insert_one({"username": data.get("username"), "password": data.get("password")})
+    with timed_stage('mongo'):
+        get_db()['users'].insert_one({"username": data.get("username"), "password": data.get("password")})
     return 'Success!'
 
-@app.route('/api/chat', methods=['POST'])
+@api.route('/api/chat', methods=['POST'])
 def send_chat():
 
     try:
@@ -217,28 +262,90 @@ def send_chat():
         relevant_docs = retrieve_relevant_documents(
             query=user_message,
             documents=documents,
-            client=cohere_client
+            client=get_cohere_client()
         )
         
+        # Answer repeated questions over the same documents from the cache
+        cached, cache_info = chat_cache.lookup(user_message, relevant_docs)
+        if cached is not None:
+            if wants_event_stream():
+                return event_stream_response(replay_chat_events(cached, cache_info))
+            return jsonify({**cached, "cache": cache_info})
+        
         # Prepare messages for the chat
         messages = [{"role": "user", "content": user_message}]
         
+        # Stream tokens as Server-Sent Events if the client asked for them
+        if wants_event_stream():
+            return event_stream_response(
+                stream_chat_events(user_message, messages, relevant_docs, cache_info.get("embedding"))
+            )
+        
         # Generate response using retrieved documents
-        response = cohere_client.chat(
-            model="command-r",
-            messages=messages,
-            documents=relevant_docs
-        )
+        with timed_stage('cohere_chat'):
+            response = get_cohere_client().chat(
+                model="command-r",
+                messages=messages,
+                documents=relevant_docs
+            )
         
-        return jsonify({
+        result = {
             "reply": response.message.content[0].text,
             "relevant_documents": relevant_docs  # Optionally return used documents
-        })
+        }
+        chat_cache.store(user_message, relevant_docs, result, cache_info.get("embedding"))
+        
+        return jsonify({**result, "cache": {"hit": False}})
         
     except Exception as e:
         print(f"Error in chat endpoint: {str(e)}")
         return jsonify({"error": str(e)}), 500
     
+def wants_event_stream():
+    """Whether the chat client asked for a streamed reply via ?stream=1 or Accept: text/event-stream"""
+    return arg_flag('stream') or request.accept_mimetypes.best == 'text/event-stream'
+
+def event_stream_response(events):
+    # Keep the request and app context alive while the generator runs, so it uses this app's clients
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # keep reverse proxies from buffering the stream
+    })
+
+def sse_event(event, data):
+    """Format one Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_chat_events(user_message, messages, relevant_docs, embedding=None):
+    """Yield the retrieved documents, then each generated token, then the full reply"""
+    yield sse_event("documents", {"relevant_documents": relevant_docs, "cache": {"hit": False}})
+    try:
+        reply = []
+        with timed_stage('cohere_chat_stream'):
+            for chunk in get_cohere_client().chat_stream(
+                model="command-r",
+                messages=messages,
+                documents=relevant_docs
+            ):
+                if chunk.type == "content-delta":
+                    text = chunk.delta.message.content.text
+                    reply.append(text)
+                    yield sse_event("token", {"text": text})
+        
+        result = {"reply": "".join(reply), "relevant_documents": relevant_docs}
+        chat_cache.store(user_message, relevant_docs, result, embedding)
+        yield sse_event("done", {"reply": result["reply"]})
+        
+    except Exception as e:
+        print(f"Error in chat stream: {str(e)}")
+        yield sse_event("error", {"error": str(e)})
+
+def replay_chat_events(cached, cache_info):
+    """Stream a cached reply using the same event sequence as a live one"""
+    yield sse_event("documents", {"relevant_documents": cached["relevant_documents"], "cache": cache_info})
+    yield sse_event("token", {"text": cached["reply"]})
+    yield sse_event("done", {"reply": cached["reply"]})
+
 def retrieve_relevant_documents(
     query: str,
     documents: List[Dict],
@@ -246,39 +353,45 @@ def retrieve_relevant_documents(
     top_k: int = 3
 ) -> List[Dict]:
     """
-    Retrieve the most relevant documents for a given query using Cohere's rerank capabilities.
+    Retrieve the most relevant documents for a given query using the local BM25 index,
+    optionally reranking the shortlisted candidates with Cohere (CHAT_REMOTE_RERANK=1).
     
     Args:
         query: The user's query string
         documents: List of documents to search through
-        client: Initialized Cohere client
+        client: Initialized Cohere client, only used for remote reranking
         top_k: Number of documents to retrieve (default: 3)
         
     Returns:
         List of the most relevant documents
     """
     try:
-        # Prepare documents for reranking
-        docs_for_rerank = [
-            {
-                "text": f"{doc['data']['title']}\n{doc['data']['text']}",
-                "index": idx
-            }
-            for idx, doc in enumerate(documents)
-        ]
+        with timed_stage('local_retrieval'):
+            index = get_tips_index(documents)
+            matches = index.search(query, max(top_k, CHAT_RERANK_CANDIDATES) if CHAT_REMOTE_RERANK else top_k)
         
-        # Rerank documents based on query
-        rerank_response = client.rerank(
-            query=query,
-            documents=[doc["text"] for doc in docs_for_rerank],
-            top_n=top_k,
-            model="rerank-english-v2.0"
-        )
+        if not CHAT_REMOTE_RERANK:
+            return [
+                {**documents[idx], "relevance_score": round(score, 4)}
+                for idx, score in matches
+            ]
+        
+        # Rerank only the locally shortlisted candidates
+        candidates = [idx for idx, _ in matches]
+        if not candidates:
+            return []
+        with timed_stage('cohere_rerank'):
+            rerank_response = client.rerank(
+                query=query,
+                documents=[index.texts[idx] for idx in candidates],
+                top_n=min(top_k, len(candidates)),
+                model="rerank-english-v2.0"
+            )
         
         # Get original documents in ranked order
         relevant_docs = []
         for result in rerank_response.results:
-            original_doc = documents[docs_for_rerank[result.index]["index"]]
+            original_doc = documents[candidates[result.index]]
             relevant_doc = {
                 **original_doc,
                 "relevance_score": result.relevance_score
@@ -292,61 +405,49 @@ def retrieve_relevant_documents(
         return []
 
 # get method is a POST requestt bc idk, GET can't handle request bodies
-@app.route('/api/stocks/all/<symbol>/', methods=['GET'])
+@api.route('/api/stocks/all/<symbol>/', methods=['GET'])
 def get_stock_data(symbol):
     try:
         # Get window parameters from query string
         window_size = request.args.get('window_size', default=6, type=int)
         window_unit = request.args.get('window_unit', default='months', type=str)
         
-        # Calculate interval based on window size
-        interval_str, min_periods = calculate_interval(window_size, window_unit)
+        max_points = request.args.get('max_points', type=int)
         
-        # Calculate date range
-        end_date = datetime.now()
-        delta = get_time_delta(window_size, window_unit)
-        start_date = end_date - delta
-        
-        # Create ticker object
-        ticker = yf.Ticker(symbol)
-        
-        # Get historical data
-        df = ticker.history(
-            start=start_date,
-            end=end_date,
-            interval=interval_str,
-            actions=False
-        )
+        if max_points:
+            # Fetch daily bars and reduce them to at most max_points, caching the result
+            method = request.args.get('downsample', default='lttb', type=str)
+            if method not in DOWNSAMPLERS or not 4 <= max_points <= CHART_MAX_POINTS:
+                raise ValueError(f'downsample must be one of {", ".join(DOWNSAMPLERS)} '
+                                 f'and max_points between 4 and {CHART_MAX_POINTS}')
+            key = (symbol.upper(), window_size, window_unit, CHART_INTERVAL, max_points, method)
+            (columns, stats), version, degraded = versioned_payload(chart_cache, key, lambda: load_stock_window(
+                symbol, window_size, window_unit, CHART_INTERVAL, max_points, method),
+                window_fingerprint, window_degraded)
+        else:
+            # Calculate interval based on window size
+            interval_str, min_periods = calculate_interval(window_size, window_unit)
+            
+            # Identical concurrent requests share a single fetch and stats computation
+            (columns, stats), version, degraded = versioned_payload(
+                window_cache, ('window', symbol.upper(), window_size, window_unit, interval_str),
+                lambda: load_stock_window(symbol, window_size, window_unit, interval_str),
+                window_fingerprint, window_degraded
+            )
         
-        # Calculate stats
-        stats = {
-            'average_price': convert_to_native_types(df['Close'].mean()),
-            'highest_price': convert_to_native_types(df['High'].max()),
-            'lowest_price': convert_to_native_types(df['Low'].min()),
-            'total_volume': convert_to_native_types(df['Volume'].sum()),
-            'window_size': window_size,
-            'window_unit': window_unit,
-            'interval_used': interval_str
-        }
-        
-        # Convert DataFrame to list of dictionaries
-        result = []
-        for index, row in df.iterrows():
-            data_point = {
-                'date': index.strftime('%Y-%m-%d'),
-                'open': convert_to_native_types(row['Open']),
-                'close': convert_to_native_types(row['Close']),
-                'high': convert_to_native_types(row['High']),
-                'low': convert_to_native_types(row['Low']),
-                'volume': convert_to_native_types(row['Volume']),
-                'stats': stats
-            }
-            result.append(data_point)
+        # Stats are returned once unless the legacy per-row shape is requested
+        if arg_flag('legacy'):
+            return cached_response(version, lambda: jsonify({
+                'status': 'success',
+                'data': [{**point, 'stats': stats} for point in columns_to_records(columns)]
+            }), degraded)
         
-        return jsonify({
+        # Repeat loads of unchanged data get a 304 without re-encoding the payload
+        return cached_response(version, lambda: api_response({
             'status': 'success',
-            'data': result
-        })
+            'data': columns if request.args.get('orient') == 'columns' else columns_to_records(columns),
+            'stats': stats
+        }, table=columns), degraded)
         
     except Exception as e:
         return jsonify({
@@ -354,121 +455,138 @@ def get_stock_data(symbol):
             'message': str(e)
         }), 400
 
-@app.route('/api/stocks/all/')
-def get_top_performers():
+def load_stock_window(symbol, window_size, window_unit, interval_str, max_points=None, method='lttb'):
+    """
+    Get the price columns and summary stats for a symbol over a trailing window. With
+    max_points the rows are downsampled by method after the stats are computed.
+    """
+    # Calculate date range
+    end_date = datetime.now()
+    delta = get_time_delta(window_size, window_unit)
+    start_date = end_date - delta
+    
+    # Get historical data through the shared cache
+    df = fetch_history(
+        symbol,
+        interval=interval_str,
+        start=start_date,
+        end=end_date
+    )
+    
+    # Calculate stats
+    stats = {
+        'average_price': convert_to_native_types(df['Close'].mean()),
+        'highest_price': convert_to_native_types(df['High'].max()),
+        'lowest_price': convert_to_native_types(df['Low'].min()),
+        'total_volume': convert_to_native_types(df['Volume'].sum()),
+        'window_size': window_size,
+        'window_unit': window_unit,
+        'interval_used': interval_str
+    }
+    
+    if max_points:
+        df = df[df['Close'].notna()]
+        df = df.iloc[DOWNSAMPLERS[method](df['Close'].to_numpy(dtype=float), max_points)]
+        stats.update({'downsample': method, 'points': len(df)})
+    
+    # Convert whole columns at once
+    with timed_stage('serialization'):
+        return price_columns(df), stats
+
+@api.route('/api/stocks/indicators/<symbol>/', methods=['GET'])
+def get_stock_indicators(symbol):
     try:
-        # Get list of major US tickers
-        symbols = get_major_us_tickers()
+        # Get window parameters from query string
+        window_size = request.args.get('window_size', default=6, type=int)
+        window_unit = request.args.get('window_unit', default='months', type=str)
+        spans = parse_spans(request.args.get('spans', default=''))
         
-        # Fetch data for all stocks in parallel
-        performances = []
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_symbol = {executor.submit(get_stock_performance, symbol): symbol for symbol in symbols}
-            
-            for future in as_completed(future_to_symbol):
-                result = future.result()
-                if result is not None:
-                    performances.append(result)
+        # Identical concurrent requests share a single fetch and computation
+        (columns, summary), version, degraded = versioned_payload(
+            window_cache, ('indicators', symbol.upper(), window_size, window_unit, spans),
+            lambda: load_indicators(symbol, window_size, window_unit, spans),
+            lambda payload: [payload[1], columns_version(payload[0])]
+        )
         
-        # Sort by market cap to get the absolute largest companies
-        largest_companies = sorted(performances, key=lambda x: x['market_cap'], reverse=True)[:5]
+        return cached_response(version, lambda: api_response({
+            'status': 'success',
+            'data': columns if request.args.get('orient') == 'columns' else columns_to_records(columns),
+            'summary': summary
+        }, table=columns), degraded)
         
-        # Add rank to each company
-        for i, company in enumerate(largest_companies, 1):
-            company['rank'] = i
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
+@api.route('/api/stocks/compare', methods=['GET'])
+def compare_stocks():
+    try:
+        # Get symbols and window parameters from query string
+        symbols = list(dict.fromkeys(symbol.strip().upper() for symbol in request.args.get('symbols', '').split(',')
+                                     if symbol.strip()))
+        if not 2 <= len(symbols) <= COMPARE_MAX_SYMBOLS:
+            raise ValueError(f'symbols must list 2 to {COMPARE_MAX_SYMBOLS} tickers')
+        window_size = request.args.get('window_size', default=6, type=int)
+        window_unit = request.args.get('window_unit', default='months', type=str)
         
-        # Create market summary
-        market_summary = {
-            'total_market_cap_billions': convert_to_native_types(sum(p['market_cap_billions'] for p in largest_companies)),
-            'average_monthly_return': convert_to_native_types(np.mean([p['monthly_return'] for p in largest_companies])),
-            'average_pe_ratio': convert_to_native_types(np.mean([p['pe_ratio'] for p in largest_companies if p['pe_ratio'] is not None])),
-            'companies_analyzed': len(performances),
-            'timestamp': pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'represented_sectors': list(set(p['sector'] for p in largest_companies if p['sector'] != 'Unknown')),
-            'total_daily_volume': convert_to_native_types(sum(p['avg_daily_volume'] for p in largest_companies))
-        }
+        # Identical concurrent requests share a single fetch and computation
+        payload, version, degraded = versioned_payload(
+            window_cache, ('compare', tuple(symbols), window_size, window_unit),
+            lambda: load_comparison(symbols, window_size, window_unit),
+            lambda payload: [payload['stats'], payload['missing_symbols'],
+                             columns_version({'date': payload['data']['dates'], **payload['data']['series']})],
+            lambda payload: bool(payload['missing_symbols'])
+        )
         
-        return jsonify({
-            'status': 'success',
-            'data': {
-                'top_companies': largest_companies,
-                'market_summary': market_summary
-            }
-        })
+        table = {'date': payload['data']['dates'], **payload['data']['series']}
+        return cached_response(version, lambda: api_response({'status': 'success', **payload}, table=table),
+                               degraded)
         
     except Exception as e:
         return jsonify({
             'status': 'error',
             'message': str(e)
         }), 400
+
+@api.route('/api/stocks/all/')
+def get_top_performers():
+    return snapshot_response('top_performers')
     
-@app.route('/api/stocks/low-risk')
+@api.route('/api/stocks/low-risk')
 def get_top_funds():
+    return snapshot_response('top_funds')
+
+# Snapshot fields holding ranked entries; other lists (skipped_symbols) are passed through as is
+RANKED_FIELDS = ('top_companies', 'top_performers')
+
+def snapshot_response(name):
+    """Serve the latest precomputed snapshot along with its age"""
     try:
-        # Get list of funds and bonds
-        ticker_dict = get_major_fund_tickers()
-        all_tickers = ticker_dict['Mutual Funds'] + ticker_dict['Bond Funds']
-        
-        # Fetch data for all funds in parallel
-        performances = []
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_symbol = {executor.submit(get_fund_performance, symbol): symbol 
-                              for symbol in all_tickers}
-            
-            for future in as_completed(future_to_symbol):
-                result = future.result()
-                if result is not None:
-                    performances.append(result)
-        
-        # Sort by yearly return to get the top performers
-        top_performers = sorted(performances, 
-                              key=lambda x: x['returns']['yearly'], 
-                              reverse=True)[:5]
-        
-        # Add rank to each fund
-        for i, fund in enumerate(top_performers, 1):
-            fund['rank'] = i
-        
-        # Create summary statistics
-        summary = {
-            'total_assets_analyzed_billions': convert_to_native_types(
-                sum(p['total_assets_billions'] for p in performances)
-            ),
-            'average_returns': {
-                'monthly': convert_to_native_types(
-                    np.mean([p['returns']['monthly'] for p in performances])
-                ),
-                'quarterly': convert_to_native_types(
-                    np.mean([p['returns']['quarterly'] for p in performances])
-                ),
-                'yearly': convert_to_native_types(
-                    np.mean([p['returns']['yearly'] for p in performances])
-                )
-            },
-            'average_expense_ratio': convert_to_native_types(
-                np.mean([p['expense_ratio'] for p in performances])
-            ),
-            'average_yield': convert_to_native_types(
-                np.mean([p['yield'] for p in performances])
-            ),
-            'average_volatility': convert_to_native_types(
-                np.mean([p['volatility'] for p in performances])
-            ),
-            'funds_analyzed': len(performances),
-            'timestamp': pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'category_breakdown': {
-                'Mutual Funds': len([p for p in performances if p['category'] == 'Mutual Fund']),
-                'Bond Funds': len([p for p in performances if p['category'] == 'Bond Fund'])
-            }
-        }
+        snapshot = leaderboard_snapshots.get(name)
         
-        return jsonify({
-            'status': 'success',
-            'data': {
-                'top_performers': top_performers,
-                'summary': summary
-            }
-        })
+        def build():
+            data = snapshot['data']
+            if not arg_flag('include_series'):
+                data = {key: [without_series(entry) for entry in value] if key in RANKED_FIELDS else value
+                        for key, value in data.items()}
+            if request.args.get('orient') == 'columns':
+                data = {key: records_to_columns(value) if key in RANKED_FIELDS else value
+                        for key, value in data.items()}
+            return api_response({
+                'status': 'success',
+                'data': data,
+                'generated_at': datetime.fromtimestamp(snapshot['generated_at']).strftime('%Y-%m-%d %H:%M:%S'),
+                'age_seconds': round(time.time() - snapshot['generated_at'], 1),
+                'stale': snapshot['error'] is not None
+            })
+        
+        # The ETag follows the snapshot contents, so a rebuild with unchanged numbers still answers 304.
+        # Stale or incomplete leaderboards are revalidated on every load instead of cached until the open
+        stale = snapshot['error'] is not None
+        return cached_response([snapshot_version(snapshot), stale], build,
+                               stale or bool(snapshot['data'].get('skipped_symbols')))
         
     except Exception as e:
         return jsonify({
@@ -476,6 +594,219 @@ def get_top_funds():
             'message': str(e)
         }), 400
 
+def snapshot_version(snapshot):
+    """Hash of a snapshot's data without its build timestamps, computed once per snapshot"""
+    if 'version' not in snapshot:
+        strip = lambda value: ({key: strip(item) for key, item in value.items() if key != 'timestamp'}
+                               if isinstance(value, dict) else
+                               [strip(item) for item in value] if isinstance(value, list) else value)
+        snapshot['version'] = data_version(strip(snapshot['data']))
+    return snapshot['version']
+
+def build_top_performers():
+    """Rank the largest US companies and summarize them for /api/stocks/all/"""
+    # Get the configured universe of US tickers
+    symbols = get_universe('stocks')
+    
+    # Keep only the running top-k across chunks so memory stays flat as the universe grows
+    largest_companies, skipped, analyzed = [], [], 0
+    for chunk in chunked(symbols, UNIVERSE_CHUNK_SIZE):
+        # Download recent prices for every symbol in the chunk in one batch
+        prices = fetch_history_batch(chunk, period="1mo")
+        
+        # Fetch info for the chunk in parallel, giving up on symbols that miss the deadline
+        results, chunk_skipped = fan_out({symbol: (performance_flight.do, ('stock', symbol), get_stock_performance,
+                                                   symbol, history_slice(prices, symbol))
+                                          for symbol in chunk})
+        performances = [dict(result) for result in results.values() if result is not None]
+        skipped += chunk_skipped
+        analyzed += len(performances)
+        
+        # Select the largest companies by market cap seen so far
+        candidates = largest_companies + performances
+        market_caps = record_array(candidates, ['market_cap'])['market_cap']
+        largest_companies = [candidates[i] for i in top_k(market_caps, LEADERBOARD_SIZE)]
+        
+        # Attach chart series to new leaders while this chunk's prices are at hand
+        for company in largest_companies:
+            company.setdefault('series', compact_series(history_slice(prices, company['symbol'])))
+    
+    if not largest_companies:
+        raise ValueError('No stock data available')
+    
+    # Add rank to each company
+    for i, company in enumerate(largest_companies, 1):
+        company['rank'] = i
+    
+    # Create market summary in one pass over the leaders' columns
+    columns = record_array(largest_companies, ['market_cap_billions', 'monthly_return', 'pe_ratio', 'avg_daily_volume'])
+    pe_ratios = columns['pe_ratio'][~np.isnan(columns['pe_ratio'])]
+    market_summary = {
+        'total_market_cap_billions': convert_to_native_types(columns['market_cap_billions'].sum()),
+        'average_monthly_return': convert_to_native_types(columns['monthly_return'].mean()),
+        'average_pe_ratio': convert_to_native_types(pe_ratios.mean() if len(pe_ratios) else np.nan),
+        'companies_analyzed': analyzed,
+        'timestamp': pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'represented_sectors': list(set(p['sector'] for p in largest_companies if p['sector'] != 'Unknown')),
+        'total_daily_volume': convert_to_native_types(columns['avg_daily_volume'].sum())
+    }
+    
+    return {
+        'top_companies': largest_companies,
+        'market_summary': market_summary,
+        'skipped_symbols': skipped
+    }
+
+FUND_SUMMARY_FIELDS = ['total_assets_billions', 'expense_ratio', 'yield', 'volatility']
+
+def build_top_funds():
+    """Rank the best performing mutual and bond funds and summarize them for /api/stocks/low-risk"""
+    # Get the configured universe of funds and bonds
+    all_tickers = get_universe('funds')
+    
+    # Keep the running top-k and only the numeric columns the summary needs per chunk
+    top_performers, skipped, summary_chunks = [], [], []
+    for chunk in chunked(all_tickers, UNIVERSE_CHUNK_SIZE):
+        # Download a year of prices for the chunk in one batch and compute all returns at once
+        frame = fetch_history_batch(chunk, period="1y")
+        prices, dates = close_matrix(frame, chunk)
+        metrics = compute_fund_returns(prices, dates)
+        
+        # Fetch info for the chunk in parallel, giving up on symbols that miss the deadline
+        results, chunk_skipped = fan_out({symbol: (performance_flight.do, ('fund', symbol), get_fund_performance,
+                                                   symbol, {name: values[i] for name, values in metrics.items()})
+                                          for i, symbol in enumerate(chunk)})
+        performances = [dict(result) for result in results.values() if result is not None]
+        skipped += chunk_skipped
+        if not performances:
+            continue
+        
+        columns = record_array(performances, FUND_SUMMARY_FIELDS)
+        for horizon in RETURN_HORIZONS:
+            columns[horizon] = np.array([p['returns'][horizon] for p in performances], dtype=float)
+        columns['is_bond'] = np.array([p['category'] == 'Bond Fund' for p in performances])
+        summary_chunks.append(columns)
+        
+        # Select the top performers by yearly return seen so far
+        candidates = top_performers + performances
+        yearly = np.concatenate([record_array(top_performers, ['yearly'], lambda p: p['returns'])['yearly'],
+                                 columns['yearly']])
+        top_performers = [candidates[i] for i in top_k(yearly, LEADERBOARD_SIZE)]
+        
+        # Attach chart series to new leaders while this chunk's prices are at hand
+        for fund in top_performers:
+            fund.setdefault('series', compact_series(history_slice(frame, fund['symbol'])))
+    
+    if not top_performers:
+        raise ValueError('No fund data available')
+    
+    # Add rank to each fund
+    for i, fund in enumerate(top_performers, 1):
+        fund['rank'] = i
+    
+    # Create summary statistics in one vectorized pass over every analyzed fund
+    columns = {key: np.concatenate([chunk[key] for chunk in summary_chunks]) for key in summary_chunks[0]}
+    bonds = int(columns['is_bond'].sum())
+    summary = {
+        'total_assets_analyzed_billions': convert_to_native_types(columns['total_assets_billions'].sum()),
+        'average_returns': {horizon: convert_to_native_types(columns[horizon].mean()) for horizon in RETURN_HORIZONS},
+        'average_expense_ratio': convert_to_native_types(columns['expense_ratio'].mean()),
+        'average_yield': convert_to_native_types(columns['yield'].mean()),
+        'average_volatility': convert_to_native_types(columns['volatility'].mean()),
+        'funds_analyzed': len(columns['is_bond']),
+        'timestamp': pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'category_breakdown': {
+            'Mutual Funds': len(columns['is_bond']) - bonds,
+            'Bond Funds': bonds
+        }
+    }
+    
+    return {
+        'top_performers': top_performers,
+        'summary': summary,
+        'skipped_symbols': skipped
+    }
+
+LEADERBOARD_SIZE = 5
+LEADERBOARD_SERIES_POINTS = int(os.environ.get('LEADERBOARD_SERIES_POINTS', 30))
+
+def compact_series(hist, max_points=LEADERBOARD_SERIES_POINTS):
+    """Downsampled date and close columns for a leaderboard entry's chart"""
+    hist = hist[hist['Close'].notna()]
+    hist = hist.iloc[lttb_indices(hist['Close'].to_numpy(dtype=float), max_points)]
+    return {
+        'date': hist.index.strftime('%Y-%m-%d').tolist(),
+        'close': np.round(hist['Close'].to_numpy(dtype=float), 3).tolist()
+    }
+
+def without_series(entry):
+    """Drop the chart series from a leaderboard entry unless the client asked for it"""
+    if isinstance(entry, dict) and 'series' in entry:
+        return {key: value for key, value in entry.items() if key != 'series'}
+    return entry
+
+def top_k(values, k):
+    """
+    Indices of the k largest values, largest first, in O(n + k log k) using argpartition
+    instead of a full sort. NaN values rank last.
+    """
+    values = np.where(np.isnan(values), -np.inf, np.asarray(values, dtype=float))
+    k = min(k, len(values))
+    if k == 0:
+        return np.array([], dtype=int)
+    candidates = np.argpartition(-values, k - 1)[:k]
+    return candidates[np.argsort(-values[candidates], kind='stable')]
+
+def record_array(records, fields, source=None):
+    """Pull numeric fields out of a list of dicts into float arrays, with None as NaN"""
+    source = source or (lambda record: record)
+    return {field: np.array([source(record)[field] for record in records], dtype=float) for field in fields}
+
+def chunked(items, size):
+    """Yield consecutive slices of at most size items"""
+    size = max(size, 1)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# Ticker universes
+
+UNIVERSE_CHUNK_SIZE = int(os.environ.get('UNIVERSE_CHUNK_SIZE', 200))
+UNIVERSE_SOURCES = {
+    'stocks': os.environ.get('STOCK_UNIVERSE', ''),
+    'funds': os.environ.get('FUND_UNIVERSE', ''),
+}
+
+def get_universe(name):
+    """
+    Get the symbols to rank for a leaderboard. STOCK_UNIVERSE / FUND_UNIVERSE may name a
+    file (one symbol per line, a CSV whose first column is the symbol, or a JSON list or
+    dict of lists) or a Mongo collection as mongo:<collection> with a symbol field per
+    document. Unset, the built-in lists are used.
+    """
+    source = UNIVERSE_SOURCES[name]
+    if not source:
+        if name == 'funds':
+            ticker_dict = get_major_fund_tickers()
+            return ticker_dict['Mutual Funds'] + ticker_dict['Bond Funds']
+        return get_major_us_tickers()
+    return universe_cache.get_or_load(source, lambda: load_universe(source))
+
+def load_universe(source):
+    """Read and de-duplicate the symbols of a universe source, keeping their order"""
+    if source.startswith('mongo:'):
+        documents = get_db()[source[len('mongo:'):]].find({}, {'symbol': 1, '_id': 0})
+        symbols = [document.get('symbol') for document in documents]
+    elif source.endswith('.json'):
+        with open(source) as f:
+            data = json.load(f)
+        symbols = [symbol for group in data.values() for symbol in group] if isinstance(data, dict) else data
+    else:
+        with open(source) as f:
+            symbols = [line.split('#')[0].split(',')[0] for line in f]
+    symbols = [str(symbol).strip().upper() for symbol in symbols if symbol]
+    symbols = [symbol for symbol in symbols if symbol and symbol != 'SYMBOL']  # skip a CSV header
+    return list(dict.fromkeys(symbols))
+
 def get_major_fund_tickers():
     """Get list of major mutual funds and bond ETFs"""
     return {
@@ -505,28 +836,27 @@ def get_major_fund_tickers():
         ]
     }
 
-def get_fund_performance(symbol):
-    """Get performance metrics for a single fund or bond"""
+def get_fund_performance(symbol, metrics=None):
+    """Get performance metrics for a single fund or bond, optionally from precomputed compute_fund_returns() values"""
     try:
-        fund = yf.Ticker(symbol)
-        info = fund.info
+        info = fetch_info(symbol)
         
-        # Get historical data for different time periods
-        hist_1mo = fund.history(period="1mo")
-        hist_3mo = fund.history(period="3mo")
-        hist_1yr = fund.history(period="1y")
+        # Compute returns from a single 1y history unless they were computed in bulk
+        if metrics is None:
+            hist = fetch_history(symbol, period="1y")
+            if len(hist) == 0:
+                return None
+            metrics = {name: values[0] for name, values in
+                       compute_fund_returns(hist['Close'].to_numpy()[np.newaxis, :], hist.index).items()}
         
-        if len(hist_1mo) == 0:
+        if np.isnan(metrics['current_price']):
             return None
         
-        # Calculate returns for different periods
-        current_price = hist_1mo['Close'].iloc[-1]
-        monthly_return = ((current_price - hist_1mo['Close'].iloc[0]) / hist_1mo['Close'].iloc[0]) * 100
-        quarterly_return = ((current_price - hist_3mo['Close'].iloc[0]) / hist_3mo['Close'].iloc[0]) * 100
-        yearly_return = ((current_price - hist_1yr['Close'].iloc[0]) / hist_1yr['Close'].iloc[0]) * 100
-        
-        # Calculate volatility (standard deviation of returns)
-        volatility = np.std(hist_1yr['Close'].pct_change()) * np.sqrt(252) * 100  # Annualized volatility
+        current_price = metrics['current_price']
+        monthly_return = metrics['monthly']
+        quarterly_return = metrics['quarterly']
+        yearly_return = metrics['yearly']
+        volatility = metrics['volatility']
         
         return {
             'symbol': symbol,
@@ -552,6 +882,53 @@ def get_fund_performance(symbol):
         print(f"Error processing {symbol}: {str(e)}")
         return None
 
+RETURN_HORIZONS = {
+    'monthly': {'months': 1},
+    'quarterly': {'months': 3},
+    'yearly': {'years': 1},
+}
+
+def close_matrix(frame, symbols):
+    """Align the closing prices of a batch frame into a (symbols x days) array and its date index"""
+    closes = frame.xs('Close', axis=1, level=1).reindex(columns=[symbol.upper() for symbol in symbols])
+    return closes.to_numpy(dtype=float).T, closes.index
+
+def compute_fund_returns(prices, dates):
+    """
+    Compute returns over RETURN_HORIZONS and annualized volatility for every row of a
+    (funds x days) price matrix, where missing prices are NaN and dates index the columns.
+    Returns a dict of arrays with one value per fund, in percent (plus current_price).
+    """
+    prices = np.asarray(prices, dtype=float)
+    n_funds, n_days = prices.shape
+    if n_days == 0:
+        return {name: np.full(n_funds, np.nan) for name in ['current_price', *RETURN_HORIZONS, 'volatility']}
+    
+    rows = np.arange(n_funds)
+    valid = ~np.isnan(prices)
+    
+    # Forward-fill gaps so every day carries the latest known price
+    last_valid = np.maximum.accumulate(np.where(valid, np.arange(n_days), -1), axis=1)
+    filled = np.where(last_valid >= 0, prices[rows[:, np.newaxis], np.maximum(last_valid, 0)], np.nan)
+    current_price = filled[:, -1]
+    
+    metrics = {'current_price': current_price}
+    for name, offset in RETURN_HORIZONS.items():
+        # Base price is the first available close on or after the start of the horizon
+        start = min(dates.searchsorted(dates[-1] - pd.DateOffset(**offset)), n_days - 1)
+        window = valid[:, start:]
+        base = np.where(window.any(axis=1), prices[rows, start + np.argmax(window, axis=1)], np.nan)
+        metrics[name] = (current_price - base) / base * 100
+    
+    # Annualized volatility of daily returns
+    with np.errstate(divide='ignore', invalid='ignore'):
+        daily_returns = filled[:, 1:] / filled[:, :-1] - 1
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # funds without data produce all-NaN rows
+        metrics['volatility'] = np.nanstd(daily_returns, axis=1) * np.sqrt(252) * 100
+    
+    return metrics
+
 def get_major_us_tickers():
     """Get list of major US company tickers"""
     return [
@@ -588,14 +965,14 @@ def get_major_us_tickers():
         'MCD',    # McDonald's
     ]
 
-def get_stock_performance(symbol):
-    """Get performance metrics for a single stock"""
+def get_stock_performance(symbol, hist=None):
+    """Get performance metrics for a single stock, optionally from a prefetched 1mo history"""
     try:
-        stock = yf.Ticker(symbol)
-        info = stock.info
+        info = fetch_info(symbol)
         
         # Get recent price data
-        hist = stock.history(period="1mo")
+        if hist is None:
+            hist = fetch_history(symbol, period="1mo")
         
         if len(hist) == 0:
             return None
@@ -626,6 +1003,261 @@ def get_stock_performance(symbol):
         print(f"Error processing {symbol}: {str(e)}")
         return None
 
+PRICE_FIELDS = {
+    'open': 'Open',
+    'close': 'Close',
+    'high': 'High',
+    'low': 'Low',
+    'volume': 'Volume',
+}
+
+def price_columns(df, decimal_places=3):
+    """Convert an OHLCV frame into native Python lists, one per field, rounding each column in one pass"""
+    columns = {'date': df.index.strftime('%Y-%m-%d').tolist()}
+    for field, column in PRICE_FIELDS.items():
+        values = df[column].to_numpy()
+        if not np.issubdtype(values.dtype, np.integer):
+            values = np.round(values.astype(float), decimal_places)
+        columns[field] = values.tolist()
+        if values.dtype.kind == 'f' and np.isnan(values).any():
+            columns[field] = [None if np.isnan(v) else v for v in columns[field]]
+    return columns
+
+def columns_to_records(columns):
+    """Turn a dict of equal-length lists into a list of row dicts"""
+    keys = list(columns)
+    return [dict(zip(keys, row)) for row in zip(*columns.values())]
+
+def records_to_columns(records):
+    """Turn a list of row dicts into a dict of lists, one per key"""
+    keys = list(dict.fromkeys(key for record in records for key in record))
+    return {key: [record.get(key) for record in records] for key in keys}
+
+def arg_flag(name, default=False):
+    """Read a boolean query string flag such as ?legacy=1 or ?legacy=true"""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+# Response encoding and compression
+
+MEDIA_TYPES = {
+    'json': 'application/json',
+    'msgpack': 'application/msgpack',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+ACCEPTED_MEDIA_TYPES = {
+    'application/json': 'json',
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+    'application/vnd.apache.arrow.stream': 'arrow',
+}
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+
+def negotiate_format():
+    """Pick the response encoding from ?format= or else the Accept header"""
+    requested = request.args.get('format')
+    if requested:
+        return requested.lower()
+    best = request.accept_mimetypes.best_match(list(ACCEPTED_MEDIA_TYPES), default='application/json')
+    return ACCEPTED_MEDIA_TYPES[best]
+
+def api_response(payload, status=200, table=None):
+    """
+    Encode payload as JSON, MessagePack or (when a columnar table is given) Arrow IPC,
+    then compress it with brotli or gzip if the client accepts it and it is large enough.
+    """
+    with timed_stage('serialization'):
+        return encode_response(payload, status, table)
+
+def encode_response(payload, status, table):
+    fmt = negotiate_format()
+    if fmt == 'json':
+        body = jsonify(payload).get_data()
+    elif fmt == 'msgpack' and optional_module('msgpack') is not None:
+        body = optional_module('msgpack').packb(payload, use_bin_type=True)
+    elif fmt == 'arrow' and optional_module('pyarrow') is not None and table is not None:
+        pa = optional_module('pyarrow')
+        metadata = {key: json.dumps(value) for key, value in payload.items() if key != 'data'}
+        arrow_table = pa.table(table).replace_schema_metadata(metadata)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+        body = sink.getvalue().to_pybytes()
+    else:
+        return jsonify({
+            'status': 'error',
+            'message': f'Unsupported response format: {fmt}'
+        }), 406
+    
+    response = Response(body, status=status, mimetype=MEDIA_TYPES[fmt])
+    response.vary.update(['Accept', 'Accept-Encoding'])
+    
+    if len(body) >= COMPRESS_MIN_BYTES:
+        encodings = request.accept_encodings
+        if optional_module('brotli') is not None and encodings['br']:
+            response.set_data(optional_module('brotli').compress(body))
+            response.content_encoding = 'br'
+        elif encodings['gzip']:
+            response.set_data(gzip.compress(body, compresslevel=6))
+            response.content_encoding = 'gzip'
+    return response
+
+# HTTP caching
+
+MARKET_TZ = ZoneInfo(os.environ.get('MARKET_TZ', 'America/New_York'))
+MARKET_OPEN = (9, 30)
+MARKET_CLOSE = (16, 0)
+MARKET_EARLY_CLOSE = (13, 0)
+MARKET_SETTLE_SECONDS = int(os.environ.get('MARKET_SETTLE_SECONDS', 900))  # late prints after the close
+CACHE_MAX_AGE_OPEN = int(os.environ.get('CACHE_MAX_AGE_OPEN', 60))  # seconds
+CACHE_MAX_AGE_CLOSED = int(os.environ.get('CACHE_MAX_AGE_CLOSED', 4 * 86400))  # seconds
+
+market_holidays = {}  # year -> set of dates the exchange is closed
+
+def nth_weekday(year, month, weekday, n):
+    """The nth given weekday (Monday is 0) of a month, counting from the end when n is negative"""
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year, month + 1, 1) - timedelta(days=1) if month < 12 else date(year, 12, 31)
+    return last - timedelta(days=(last.weekday() - weekday) % 7 + 7 * (-n - 1))
+
+def easter(year):
+    """Western Easter Sunday (anonymous Gregorian algorithm)"""
+    a, b, c = year % 19, year // 100, year % 100
+    d = (19 * a + b - b // 4 - (b - (b + 8) // 25 + 1) // 3 + 15) % 30
+    e = (32 + 2 * (b % 4) + 2 * (c // 4) - d - c % 4) % 7
+    f = d + e - 7 * ((a + 11 * d + 22 * e) // 451) + 114
+    return date(year, f // 31, f % 31 + 1)
+
+def observed(day):
+    """Holidays on a Saturday are observed on Friday, on a Sunday on Monday"""
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+def get_market_holidays(year):
+    """NYSE full-day closures for a year"""
+    if year not in market_holidays:
+        holidays = {
+            nth_weekday(year, 1, 0, 3),              # Martin Luther King Jr. Day
+            nth_weekday(year, 2, 0, 3),              # Washington's Birthday
+            easter(year) - timedelta(days=2),        # Good Friday
+            nth_weekday(year, 5, 0, -1),             # Memorial Day
+            observed(date(year, 7, 4)),              # Independence Day
+            nth_weekday(year, 9, 0, 1),              # Labor Day
+            nth_weekday(year, 11, 3, 4),             # Thanksgiving
+            observed(date(year, 12, 25)),            # Christmas
+        }
+        # New Year's Day on a Saturday is not made up on the Friday before
+        if date(year, 1, 1).weekday() != 5:
+            holidays.add(observed(date(year, 1, 1)))
+        if year >= 2022:
+            holidays.add(observed(date(year, 6, 19)))  # Juneteenth
+        market_holidays[year] = holidays
+    return market_holidays[year]
+
+def market_session(day):
+    """Open and close datetimes of the regular session on a day, or None if the exchange is closed"""
+    if day.weekday() >= 5 or day in get_market_holidays(day.year):
+        return None
+    close = MARKET_CLOSE
+    # Early closes on the day before Independence Day, the day after Thanksgiving and Christmas Eve
+    if day in (date(day.year, 7, 3), nth_weekday(day.year, 11, 3, 4) + timedelta(days=1), date(day.year, 12, 24)):
+        close = MARKET_EARLY_CLOSE
+    return (datetime(day.year, day.month, day.day, *MARKET_OPEN, tzinfo=MARKET_TZ),
+            datetime(day.year, day.month, day.day, *close, tzinfo=MARKET_TZ))
+
+def market_status(now=None):
+    """
+    Return (is_open, changes_at): whether prices can still move and when that next changes.
+    The market counts as open until MARKET_SETTLE_SECONDS after the close.
+    """
+    now = (now or datetime.now(MARKET_TZ)).astimezone(MARKET_TZ)
+    settle = timedelta(seconds=MARKET_SETTLE_SECONDS)
+    day = now.date()
+    for _ in range(14):
+        session = market_session(day)
+        if session is not None:
+            opens_at, closes_at = session
+            if now < opens_at:
+                return False, opens_at
+            if now < closes_at + settle:
+                return True, closes_at + settle
+        day += timedelta(days=1)
+    return False, now + timedelta(seconds=CACHE_MAX_AGE_CLOSED)
+
+def cache_control(now=None):
+    """Cache-Control for market data: short while trading, otherwise until the next open"""
+    now = now or datetime.now(MARKET_TZ)
+    is_open, changes_at = market_status(now)
+    seconds = int((changes_at - now).total_seconds())
+    max_age = min(CACHE_MAX_AGE_OPEN if is_open else CACHE_MAX_AGE_CLOSED, seconds)
+    return f'public, max-age={max(max_age, 0)}'
+
+def data_version(value):
+    """Hash of a JSON-like value, used as the version of the data it describes"""
+    encoded = json.dumps(value, default=str, sort_keys=True).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+def data_etag(version):
+    """Weak ETag for a data version, the response format and the query string"""
+    return data_version([version, negotiate_format(), sorted(request.args.items(multi=True))])
+
+def versioned_payload(cache, key, loader, fingerprint, degraded=lambda payload: False):
+    """
+    Get (payload, version, degraded) for key, loading the payload at most once per price
+    cache bucket. The version hashes fingerprint(payload), so a conditional request for
+    unchanged data is answered from the cache without recomputing anything. Degraded
+    payloads (missing upstream data) are not kept, so the next request tries again.
+    """
+    key = key + (bucket_datetime(datetime.now()),)
+    
+    def load():
+        payload = loader()
+        return payload, data_version(fingerprint(payload)), degraded(payload)
+    
+    entry = cache.get_or_load(key, load)
+    if entry[2]:
+        cache.discard(key)
+    return entry
+
+def cached_response(version, build, degraded=False):
+    """
+    Answer a conditional GET with 304 when the client already holds this data version,
+    otherwise build the response. Both carry the ETag and a market-hours Cache-Control,
+    except that degraded data must be revalidated on every use.
+    """
+    etag = data_etag(version)
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+        response.vary.update(['Accept', 'Accept-Encoding'])
+        metrics.inc('not_modified_total', endpoint=request.endpoint)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache' if degraded else cache_control()
+    return response
+
+def window_fingerprint(payload):
+    """Version inputs for a (columns, stats) price window"""
+    columns, stats = payload
+    return [stats, columns_version(columns)]
+
+def window_degraded(payload):
+    """A price window with no bars means the upstream fetch failed"""
+    return not payload[0]['date']
+
+def columns_version(columns):
+    """Cheap fingerprint of price columns: row count plus the first and last rows"""
+    return {key: [len(values), values[:1], values[-1:]] for key, values in columns.items()}
+
 def calculate_interval(time_window, unit):
     """
     Calculate appropriate interval based on the time window
@@ -669,6 +1301,1880 @@ def round_to_decimal_places(value, decimal_places=3):
         return round(value, decimal_places)
     return value
 
+# Metrics
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0').lower() in ('1', 'true', 'yes')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class MetricsRegistry:
+    """Minimal Prometheus registry for labelled counters and latency histograms"""
+
+    def __init__(self, prefix, buckets=LATENCY_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._counters = defaultdict(float)  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self, gauges=()):
+        """Render every metric, plus (name, labels, value) gauges, in the Prometheus text format"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+
+        samples = defaultdict(list)
+        for (name, labels), value in counters.items():
+            samples[name].append((name, labels, value))
+        for (name, labels), values in histograms.items():
+            for bound, count in zip(self.buckets, values):
+                samples[name].append((f'{name}_bucket', labels + (('le', str(bound)),), count))
+            samples[name].append((f'{name}_bucket', labels + (('le', '+Inf'),), values[-1]))
+            samples[name].append((f'{name}_sum', labels, values[-2]))
+            samples[name].append((f'{name}_count', labels, values[-1]))
+        for name, labels, value in gauges:
+            samples[name].append((name, tuple(sorted(labels.items())), value))
+
+        lines = []
+        for name in sorted(samples):
+            kind, text = self._help.get(name, ('untyped', name))
+            lines.append(f'# HELP {self.prefix}_{name} {text}')
+            lines.append(f'# TYPE {self.prefix}_{name} {kind}')
+            for sample, labels, value in samples[name]:
+                label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f'{self.prefix}_{sample}{{{label_str}}} {value}' if label_str
+                             else f'{self.prefix}_{sample} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry('bridge')
+metrics.describe('http_request_duration_seconds', 'histogram', 'Request latency by endpoint')
+metrics.describe('stage_duration_seconds', 'histogram', 'Latency of upstream calls and serialization by stage')
+metrics.describe('upstream_errors_total', 'counter', 'Failed upstream calls by stage')
+metrics.describe('upstream_timeouts_total', 'counter', 'Upstream calls that timed out or missed the fan-out deadline')
+metrics.describe('cache_hits_total', 'counter', 'Cache hits by cache')
+metrics.describe('cache_misses_total', 'counter', 'Cache misses by cache')
+metrics.describe('cache_hit_ratio', 'gauge', 'Hit ratio by cache since startup')
+metrics.describe('cache_size_bytes', 'gauge', 'Approximate cache size by cache')
+metrics.describe('singleflight_coalesced_total', 'counter', 'Calls that waited for an identical in-flight call')
+metrics.describe('upstream_queue_depth', 'gauge', 'Upstream calls waiting for a pool worker')
+metrics.describe('snapshot_age_seconds', 'gauge', 'Age of each precomputed leaderboard snapshot')
+metrics.describe('not_modified_total', 'counter', 'Conditional GETs answered with 304 by endpoint')
+
+@contextmanager
+def timed_stage(stage):
+    """Record how long a block takes as a stage latency (and Server-Timing entry) and count its failures"""
+    start = time.perf_counter()
+    try:
+        yield
+    except requests.exceptions.Timeout:
+        metrics.inc('upstream_timeouts_total', stage=stage)
+        raise
+    except Exception:
+        metrics.inc('upstream_errors_total', stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe('stage_duration_seconds', elapsed, stage=stage)
+        if has_request_context():
+            g.setdefault('stage_timings', defaultdict(float))[stage] += elapsed
+
+@api.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@api.after_app_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    metrics.observe('http_request_duration_seconds', elapsed,
+                    endpoint=request.endpoint or 'unknown', status=str(response.status_code))
+    if SERVER_TIMING or arg_flag('timing'):
+        timings = [f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in g.get('stage_timings', {}).items()]
+        timings.append(f'total;dur={elapsed * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+@api.route('/metrics')
+def get_metrics():
+    gauges = [('upstream_queue_depth', {}, upstream_executor._work_queue.qsize())]
+    scheduler_stats = upstream_scheduler.stats()
+    for priority, depth in scheduler_stats['queue_depth'].items():
+        gauges.append(('upstream_scheduler_queue_depth', {'priority': priority}, depth))
+    gauges.append(('upstream_breaker_open', {}, int(scheduler_stats['breaker_open'])))
+    for name, cache in cache_registry.items():
+        stats = cache.stats()
+        gauges += [
+            ('cache_hits_total', {'cache': name}, stats['hits']),
+            ('cache_misses_total', {'cache': name}, stats['misses']),
+            ('cache_hit_ratio', {'cache': name}, stats['hit_ratio'] or 0),
+            ('cache_size_bytes', {'cache': name}, stats['size_bytes']),
+        ]
+    for name, flight in singleflight_registry.items():
+        gauges.append(('singleflight_coalesced_total', {'name': name}, flight.coalesced))
+    for name, age in leaderboard_snapshots.ages().items():
+        gauges.append(('snapshot_age_seconds', {'snapshot': name}, round(age, 1)))
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+# Upstream connections
+
+UPSTREAM_MAX_WORKERS = int(os.environ.get('UPSTREAM_MAX_WORKERS', 16))
+UPSTREAM_CALL_TIMEOUT = float(os.environ.get('UPSTREAM_CALL_TIMEOUT', 10))  # seconds per symbol
+UPSTREAM_DEADLINE = float(os.environ.get('UPSTREAM_DEADLINE', 20))  # seconds per fan-out
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter that caps every request's timeout at its own. yfinance always asks for 30s,
+    which would keep abandoned calls holding pool threads long after fan_out gave up on them.
+    """
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        timeout = kwargs.get('timeout')
+        if timeout is None:
+            kwargs['timeout'] = self.timeout
+        elif isinstance(timeout, tuple):
+            kwargs['timeout'] = tuple(self.timeout if t is None else min(t, self.timeout) for t in timeout)
+        else:
+            kwargs['timeout'] = min(timeout, self.timeout)
+        return super().send(request, **kwargs)
+
+class UpstreamThrottled(Exception):
+    """Raised by the upstream session when Yahoo answers 429 Too Many Requests"""
+
+# yfinance swallows some request errors (Ticker.history returns an empty frame), so the
+# session also flags a 429 on the calling thread for UpstreamScheduler.call to check
+upstream_throttle = threading.local()
+
+def raise_for_throttle(response, *args, **kwargs):
+    if response.status_code == 429:
+        upstream_throttle.seen = True
+        raise UpstreamThrottled(f'429 Too Many Requests: {response.url}')
+
+def create_upstream_session():
+    """Create the pooled HTTP session shared by every yfinance call"""
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(UPSTREAM_CALL_TIMEOUT, pool_connections=4, pool_maxsize=UPSTREAM_MAX_WORKERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(raise_for_throttle)
+    return session
+
+def create_upstream_executor():
+    """Create the thread pool that runs upstream calls for fan_out"""
+    return ThreadPoolExecutor(max_workers=UPSTREAM_MAX_WORKERS, thread_name_prefix='upstream')
+
+upstream_session = create_upstream_session()
+upstream_executor = create_upstream_executor()
+
+def ticker(symbol):
+    """Create a yfinance Ticker that uses the shared upstream session"""
+    return yf.Ticker(symbol, session=upstream_session)
+
+def fan_out(calls, timeout=UPSTREAM_CALL_TIMEOUT, deadline=UPSTREAM_DEADLINE, priority=None):
+    """
+    Run {key: (fn, *args)} on the shared upstream pool with bounded concurrency.
+    A call is abandoned once it has been running for timeout seconds, and whatever is
+    unfinished when the overall deadline expires is abandoned too. The calls are
+    scheduled upstream with priority (by default the caller's own priority class).
+    Returns ({key: result} for calls that finished, [keys that were skipped]).
+    """
+    started = {}
+    priority = priority or upstream_priority.get()
+
+    def run(key, fn, *args):
+        started[key] = time.monotonic()
+        upstream_priority.set(priority)
+        return fn(*args)
+
+    futures = {upstream_executor.submit(run, key, *call): key for key, call in calls.items()}
+    deadline_at = time.monotonic() + deadline
+    results, skipped, pending = {}, [], set(futures)
+    while pending:
+        now = time.monotonic()
+        if now >= deadline_at:
+            break
+        
+        # Drop calls that have been running longer than the per-call timeout
+        for future in [f for f in pending if futures[f] in started and now - started[futures[f]] >= timeout]:
+            pending.discard(future)
+            skipped.append(futures[future])
+        
+        wake_at = min([deadline_at] + [started[futures[f]] + timeout for f in pending if futures[f] in started])
+        done, pending = wait(pending, timeout=max(wake_at - now, 0), return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                print(f"Error processing {futures[future]}: {str(e)}")
+                results[futures[future]] = None
+    
+    for future in pending:
+        future.cancel()
+        skipped.append(futures[future])
+    if skipped:
+        metrics.inc('upstream_timeouts_total', len(skipped), stage='fan_out')
+    return results, skipped
+
+# Upstream rate limiting
+
+# Budget for the whole server: gunicorn workers each get an equal share, see after_fork()
+UPSTREAM_RATE = float(os.environ.get('UPSTREAM_RATE', 10))  # Yahoo calls per second, 0 for no limit
+UPSTREAM_BURST = int(os.environ.get('UPSTREAM_BURST', 20))
+UPSTREAM_INTERACTIVE_RESERVE = int(os.environ.get('UPSTREAM_INTERACTIVE_RESERVE', 2))  # tokens background work leaves alone
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 3))
+UPSTREAM_BACKOFF_BASE = float(os.environ.get('UPSTREAM_BACKOFF_BASE', 1))  # seconds
+UPSTREAM_BACKOFF_MAX = float(os.environ.get('UPSTREAM_BACKOFF_MAX', 30))
+UPSTREAM_BREAKER_THRESHOLD = int(os.environ.get('UPSTREAM_BREAKER_THRESHOLD', 5))  # consecutive failures
+UPSTREAM_BREAKER_COOLDOWN = float(os.environ.get('UPSTREAM_BREAKER_COOLDOWN', 30))  # seconds
+UPSTREAM_PRIORITIES = {'interactive': 0, 'background': 1}
+UPSTREAM_MAX_WAIT = {'interactive': UPSTREAM_CALL_TIMEOUT, 'background': 6 * UPSTREAM_DEADLINE}
+
+# Request threads are interactive; snapshot refreshes and warmup switch themselves to background
+upstream_priority = ContextVar('upstream_priority', default='interactive')
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling Yahoo while the circuit breaker is open or the rate limit queue is too long"""
+
+class UpstreamScheduler:
+    """
+    Gate every Yahoo call through one token bucket. Waiting callers are served by
+    priority class, then in arrival order, and background work leaves a few tokens for
+    interactive requests. A throttling response pauses the whole bucket for a jittered,
+    exponentially growing delay before the call is retried; repeated failures open a
+    circuit breaker that fails calls fast until a trial call succeeds after the cooldown.
+    """
+
+    def __init__(self, rate, burst, reserve=0):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = min(reserve, max(burst - 1, 0))
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = []  # heap of (priority rank, arrival) tickets
+        self._arrivals = itertools.count()
+        self._cond = threading.Condition()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    def call(self, stage, fn, *args, priority=None):
+        """Run fn(*args) as one upstream call, timed as stage, with rate limiting and retries"""
+        priority = priority or upstream_priority.get()
+        trial = self._admit(stage)
+        try:
+            for attempt in range(UPSTREAM_RETRIES + 1):
+                self._acquire(priority)
+                upstream_throttle.seen = False
+                try:
+                    with timed_stage(stage):
+                        result = fn(*args)
+                    if upstream_throttle.seen:
+                        raise UpstreamThrottled(f'{stage} was rate limited')
+                except Exception as e:
+                    if is_throttled(e) or upstream_throttle.seen:
+                        metrics.inc('upstream_throttled_total', stage=stage)
+                        self._failed(backoff=attempt)
+                        if attempt < UPSTREAM_RETRIES and self._opened_at is None:
+                            metrics.inc('upstream_retries_total', stage=stage)
+                            continue
+                    elif isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+                        self._failed()
+                    raise
+                self._succeeded()
+                return result
+        finally:
+            if trial:
+                with self._cond:
+                    self._trial_running = False
+
+    def _admit(self, stage):
+        """Check the circuit breaker; returns True if this call is the half-open trial"""
+        with self._cond:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at >= UPSTREAM_BREAKER_COOLDOWN and not self._trial_running:
+                self._trial_running = True
+                return True
+        metrics.inc('upstream_rejected_total', stage=stage)
+        raise UpstreamUnavailable('Yahoo Finance is unavailable or throttling, try again shortly')
+
+    def _acquire(self, priority):
+        """Block until a token is available to this caller, highest priority first"""
+        rank = UPSTREAM_PRIORITIES[priority]
+        ticket = (rank, next(self._arrivals))
+        give_up_at = time.monotonic() + UPSTREAM_MAX_WAIT[priority]
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    needed = 1 + (self.reserve if rank > 0 else 0)
+                    if self._waiting[0] == ticket and now >= self._paused_until and \
+                            (self.rate <= 0 or self._tokens >= needed):
+                        if self.rate > 0:
+                            self._tokens -= 1
+                        return
+                    if now >= give_up_at:
+                        metrics.inc('upstream_rejected_total', stage='rate_limit')
+                        raise UpstreamUnavailable('Too many upstream calls queued, try again shortly')
+                    wake_at = max(self._paused_until, now + (needed - self._tokens) / self.rate if self.rate > 0 else now)
+                    self._cond.wait(timeout=min(max(wake_at - now, 0.001), give_up_at - now))
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _failed(self, backoff=None):
+        with self._cond:
+            self._failures += 1
+            now = time.monotonic()
+            if backoff is not None:
+                # Full jitter keeps throttled callers from retrying in lockstep
+                delay = random.uniform(0.5, 1) * min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** backoff)
+                self._paused_until = max(self._paused_until, now + delay)
+            if self._failures >= UPSTREAM_BREAKER_THRESHOLD or self._opened_at is not None:
+                self._opened_at = now
+            self._cond.notify_all()
+
+    def _succeeded(self):
+        with self._cond:
+            self._failures = 0
+            self._opened_at = None
+
+    def stats(self):
+        with self._cond:
+            self._refill(time.monotonic())
+            depth = {priority: 0 for priority in UPSTREAM_PRIORITIES}
+            ranks = {rank: priority for priority, rank in UPSTREAM_PRIORITIES.items()}
+            for rank, _ in self._waiting:
+                depth[ranks[rank]] += 1
+            return {
+                'queue_depth': depth,
+                'tokens': round(self._tokens, 2),
+                'paused_seconds': round(max(self._paused_until - time.monotonic(), 0), 2),
+                'breaker_open': self._opened_at is not None,
+                'consecutive_failures': self._failures
+            }
+
+def is_throttled(error):
+    """Whether an upstream error means Yahoo is rate limiting us"""
+    if isinstance(error, UpstreamThrottled):
+        return True
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) == 429:
+        return True
+    text = f'{type(error).__name__} {error}'.lower()
+    return 'ratelimit' in text or 'rate limit' in text or 'too many requests' in text
+
+def throttled_download_errors():
+    """yf.download reports per-symbol failures in a shared dict instead of raising"""
+    errors = getattr(getattr(yf, 'shared', None), '_ERRORS', None) or {}
+    return [message for message in errors.values() if is_throttled(Exception(message))]
+
+def create_upstream_scheduler(workers=1):
+    """Create this process's scheduler with its share of the server-wide rate and burst"""
+    return UpstreamScheduler(UPSTREAM_RATE / workers, max(UPSTREAM_BURST // workers, 1), UPSTREAM_INTERACTIVE_RESERVE)
+
+upstream_scheduler = create_upstream_scheduler()
+metrics.describe('upstream_throttled_total', 'counter', 'Upstream calls answered with a throttling response')
+metrics.describe('upstream_retries_total', 'counter', 'Upstream calls retried after backing off')
+metrics.describe('upstream_rejected_total', 'counter', 'Upstream calls refused by the circuit breaker or rate limit queue')
+metrics.describe('upstream_scheduler_queue_depth', 'gauge', 'Callers waiting for an upstream rate limit token')
+metrics.describe('upstream_breaker_open', 'gauge', 'Whether the upstream circuit breaker is open')
+
+# Request coalescing
+
+singleflight_registry = {}
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls by key: the first caller runs the function and any
+    identical calls that arrive while it is in flight wait for and share its result.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.coalesced = 0
+        self._calls = {}  # key -> {'done', 'result', 'error'}
+        self._lock = threading.Lock()
+        singleflight_registry[name] = self
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn(*args, **kwargs)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._calls), 'coalesced': self.coalesced}
+
+    def after_fork(self):
+        """Forget calls inherited from the parent: the threads running them do not exist here"""
+        self._calls = {}
+        self._lock = threading.Lock()
+
+performance_flight = SingleFlight('performance')
+
+# Upstream data cache
+
+PRICE_CACHE_TTL = int(os.environ.get('PRICE_CACHE_TTL', 300))  # seconds
+INFO_CACHE_TTL = int(os.environ.get('INFO_CACHE_TTL', 6 * 3600))  # seconds
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 2048))
+CACHE_MAX_MB = int(os.environ.get('CACHE_MAX_MB', 128))
+
+cache_registry = {}
+
+class TTLCache:
+    """
+    Thread-safe LRU cache with a per-entry TTL and an approximate memory cap.
+    Values are shared between callers, so they must be treated as read-only.
+    """
+
+    def __init__(self, name, ttl, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._lock = threading.Lock()
+        self._loads = SingleFlight(f'{name}_cache')
+        cache_registry[name] = self
+
+    def get(self, key, default=None, count=True):
+        """Return the cached value for key, or default if missing or expired (counted unless count=False)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            if count:
+                self._count(entry is not None)
+            return default if entry is None else entry[2]
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def set(self, key, value, ttl=None):
+        """Store value under key, evicting least recently used entries when over budget"""
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Return the cached value for key, calling loader() and caching its result on a miss"""
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        return self._loads.do(key, self._load, key, loader, ttl)
+
+    def _load(self, key, loader, ttl):
+        value = loader()
+        if not is_empty_result(value):
+            self.set(key, value, ttl)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def after_fork(self):
+        """Replace a lock that a parent thread may have held when the process forked"""
+        self._lock = threading.Lock()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size_bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+def estimate_size(value):
+    """Approximate the in-memory size of a cached value in bytes"""
+    if isinstance(value, pd.DataFrame):
+        # Only object columns need the (slow) deep inspection
+        deep = any(dtype == object for dtype in value.dtypes)
+        return int(value.memory_usage(deep=deep).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict) and any(isinstance(item, np.ndarray) for item in value.values()):
+        return sum(estimate_size(item) for item in value.values())
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return sys.getsizeof(value)
+
+def is_empty_result(value):
+    """Empty upstream results are usually failures, so they are never cached"""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.empty
+    return value is None or value == {}
+
+def bucket_datetime(dt, seconds=PRICE_CACHE_TTL):
+    """Floor a datetime to a multiple of seconds so nearby requests share a cache key"""
+    if seconds <= 0:
+        return dt
+    return datetime.fromtimestamp(dt.timestamp() // seconds * seconds)
+
+history_cache = TTLCache('history', PRICE_CACHE_TTL)
+info_cache = TTLCache('info', INFO_CACHE_TTL)
+universe_cache = TTLCache('universes', INFO_CACHE_TTL, max_entries=16)
+window_cache = TTLCache('windows', PRICE_CACHE_TTL)  # endpoint payloads with their data version
+
+def fetch_history(symbol, period=None, interval='1d', start=None, end=None):
+    """Get price history for a symbol, keyed by (symbol, period/interval, start/end bucket)"""
+    symbol = symbol.upper()
+    if start is not None:
+        start = bucket_datetime(start)
+    if end is not None:
+        end = bucket_datetime(end)
+
+    key = (symbol, period, interval, start, end)
+    return history_cache.get_or_load(key, lambda: load_history(symbol, period, interval, start, end))
+
+def load_history(symbol, period=None, interval='1d', start=None, end=None):
+    """Read history from the bar store when it covers the request, otherwise straight from yfinance"""
+    store_start = start if start is not None else period_start(period)
+    if bar_store is not None and interval in BAR_STORE_INTERVALS and store_start is not None:
+        return bar_store.get(symbol, interval, store_start, end)
+
+    kwargs = {'interval': interval, 'actions': False}
+    if period is not None:
+        kwargs['period'] = period
+    if start is not None:
+        kwargs['start'] = start
+    if end is not None:
+        kwargs['end'] = end
+    return upstream_scheduler.call('yfinance_history', lambda: ticker(symbol).history(**kwargs))
+
+HISTORY_BATCH_SIZE = int(os.environ.get('HISTORY_BATCH_SIZE', 100))
+
+# yf.download keeps its results in module-level dicts, so concurrent downloads must not overlap
+download_lock = threading.Lock()
+
+def fetch_history_batch(symbols, period='1mo', interval='1d'):
+    """
+    Get price history for many symbols as one wide frame with (symbol, field) columns.
+    Symbols are downloaded in chunks of HISTORY_BATCH_SIZE and each per-symbol slice is
+    also cached, so later fetch_history() calls for the same period are hits.
+    """
+    symbols = [symbol.upper() for symbol in symbols]
+    key = ('batch', tuple(symbols), period, interval)
+    return history_cache.get_or_load(key, lambda: load_history_batch(symbols, period, interval))
+
+def load_history_batch(symbols, period, interval):
+    """Build the wide frame for fetch_history_batch from the bar store or a direct download"""
+    start = period_start(period)
+    if bar_store is not None and interval in BAR_STORE_INTERVALS and start is not None:
+        histories = bar_store.get_many(symbols, interval, start)
+        frame = pd.concat(histories, axis=1) if histories else pd.DataFrame()
+    else:
+        frame = download_history_batch(symbols, interval, period=period)
+
+    for symbol in symbols:
+        hist = history_slice(frame, symbol)
+        if not hist.empty:
+            history_cache.set((symbol, period, interval, None, None), hist)
+    return frame
+
+def download_history_batch(symbols, interval, period=None, start=None):
+    """Download history for symbols in chunks and join them on the date index"""
+    frames = []
+    for i in range(0, len(symbols), HISTORY_BATCH_SIZE):
+        chunk = symbols[i:i + HISTORY_BATCH_SIZE]
+        frames.append(upstream_scheduler.call('yfinance_download', download_chunk, chunk, interval, period, start))
+    return pd.concat(frames, axis=1) if frames else pd.DataFrame()
+
+def download_chunk(symbols, interval, period, start):
+    with download_lock:
+        frame = yf.download(
+            symbols,
+            period=period,
+            start=start,
+            interval=interval,
+            group_by='ticker',
+            auto_adjust=True,
+            actions=False,
+            progress=False,
+            session=upstream_session
+        )
+        throttled = throttled_download_errors()
+    if throttled:
+        raise UpstreamUnavailable(f'Rate limited: {throttled[0]}')
+    return frame
+
+PERIOD_OFFSETS = {
+    '5d': {'days': 5},
+    '1mo': {'months': 1},
+    '3mo': {'months': 3},
+    '6mo': {'months': 6},
+    '1y': {'years': 1},
+    '2y': {'years': 2},
+    '5y': {'years': 5},
+    '10y': {'years': 10},
+}
+
+def period_start(period):
+    """Translate a yfinance period like '1mo' into a start date, or None if it has no fixed length"""
+    offset = PERIOD_OFFSETS.get(period)
+    if offset is None:
+        return None
+    return (pd.Timestamp.now().normalize() - pd.DateOffset(**offset)).to_pydatetime()
+
+def history_slice(frame, symbol):
+    """Get a single symbol's OHLCV history out of a batch frame"""
+    symbol = symbol.upper()
+    if frame.empty or symbol not in frame.columns.get_level_values(0):
+        return empty_history()
+    hist = frame[symbol]
+    return hist[hist['Close'].notna()]
+
+def fetch_info(symbol):
+    """Get the Yahoo Finance info dict for a symbol through the shared cache"""
+    symbol = symbol.upper()
+    return info_cache.get_or_load(symbol, lambda: load_info(symbol))
+
+def load_info(symbol):
+    return upstream_scheduler.call('yfinance_info', lambda: ticker(symbol).info)
+
+# Persistent bar store
+
+BAR_STORE_DIR = os.environ.get('BAR_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.barstore'))
+BAR_GAP_TOLERANCE = {  # days between a requested start and the first bar that still counts as covered
+    '1d': 5,
+    '1wk': 8,
+    '1mo': 32,
+}
+BAR_STORE_INTERVALS = set(BAR_GAP_TOLERANCE)
+BAR_FIELDS = ['Open', 'High', 'Low', 'Close', 'Volume']
+BAR_DTYPE = [('ts', 'i8')] + [(field, 'f8') for field in BAR_FIELDS]
+
+class BarStore:
+    """
+    On-disk OHLCV store with one memory-mapped .npy file of BAR_DTYPE records per
+    (interval, symbol). Upstream is asked only for bars from the last completed stored bar
+    onwards. The last bar is always overwritten since it may still be forming, and if the
+    completed bar no longer matches (a dividend or split re-adjusted the history) the
+    symbol is re-fetched in full.
+    """
+
+    def __init__(self, root, refresh_seconds=PRICE_CACHE_TTL):
+        self.root = root
+        self.refresh_seconds = refresh_seconds
+        self._locks = {}
+        self._checked_at = {}  # (symbol, interval) -> monotonic time of the last upstream check
+        self._covered_from = {}  # (symbol, interval) -> earliest start already requested upstream
+        self._lock = threading.Lock()
+
+    def get(self, symbol, interval, start, end=None):
+        """Get bars for one symbol between start and end, updating the store first if needed"""
+        return self.get_many([symbol], interval, start, end).get(symbol.upper(), empty_history())
+
+    def get_many(self, symbols, interval, start, end=None):
+        """Get {symbol: bars} for many symbols, fetching missing ranges in one batch download"""
+        symbols = [symbol.upper() for symbol in symbols]
+        start = pd.Timestamp(start).tz_localize(None).normalize()
+        locks = [self._key_lock(symbol, interval) for symbol in sorted(set(symbols))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            stored = {symbol: self._read(symbol, interval) for symbol in symbols}
+
+            # Symbols with no usable history need everything from start; the rest only their tail
+            full = [symbol for symbol in symbols if not self._covers(symbol, interval, stored[symbol], start)]
+            tails = [symbol for symbol in symbols if symbol not in full and self._is_due(symbol, interval)]
+            if full:
+                self._update(full, interval, start, stored)
+            if tails:
+                # Start at the last completed bar: the newest one may still be forming
+                tail_start = min(stored[symbol].index[max(len(stored[symbol]) - 2, 0)] for symbol in tails)
+                self._update(tails, interval, tail_start, stored)
+        finally:
+            for lock in locks:
+                lock.release()
+
+        end = pd.Timestamp(end).tz_localize(None) if end is not None else None
+        return {symbol: frame.loc[start:end] for symbol, frame in stored.items() if frame is not None}
+
+    def _update(self, symbols, interval, start, stored):
+        """Download bars from start onwards for symbols and merge them into stored"""
+        if len(symbols) == 1:
+            history = upstream_scheduler.call('yfinance_history', lambda: ticker(symbols[0]).history(
+                start=start, interval=interval, actions=False))
+            fetched = {symbols[0]: normalize_history(history)}
+        else:
+            frame = download_history_batch(symbols, interval, start=start)
+            fetched = {symbol: normalize_history(history_slice(frame, symbol)) for symbol in symbols}
+
+        for symbol, new in fetched.items():
+            self._checked_at[(symbol, interval)] = time.monotonic()
+            covered_from = self._covered_from.get((symbol, interval))
+            self._covered_from[(symbol, interval)] = start if covered_from is None else min(start, covered_from)
+            if new.empty:
+                continue  # upstream failed; keep serving what is on disk
+            old = stored[symbol]
+            # Only a completed bar can show a re-adjustment; the forming last bar moves with the price
+            if old is not None and new.index[0] < old.index[-1]:
+                overlap = old['Close'].get(new.index[0])
+                if overlap is not None and not np.isclose(overlap, new['Close'].iloc[0], rtol=1e-6):
+                    # History was re-adjusted, so the stored bars are no longer valid
+                    history = upstream_scheduler.call('yfinance_history', lambda: ticker(symbol).history(
+                        start=min(old.index[0], start), interval=interval, actions=False))
+                    refetched = normalize_history(history)
+                    if not refetched.empty:
+                        stored[symbol] = refetched
+                        self._write(symbol, interval, refetched)
+                    continue
+            merged = new if old is None else pd.concat([old[old.index < new.index[0]], new])
+            stored[symbol] = merged
+            self._write(symbol, interval, merged)
+
+    def _covers(self, symbol, interval, stored, start):
+        """Whether stored bars reach back to start, allowing for weekends, holidays and late listings"""
+        if stored is None:
+            return False
+        covered_from = self._covered_from.get((symbol, interval))
+        if covered_from is not None and covered_from <= start:
+            return True
+        return stored.index[0] <= start + pd.Timedelta(days=BAR_GAP_TOLERANCE[interval])
+
+    def _is_due(self, symbol, interval):
+        checked_at = self._checked_at.get((symbol, interval))
+        return checked_at is None or time.monotonic() - checked_at >= self.refresh_seconds
+
+    def after_fork(self):
+        """Replace locks that parent threads may have held when the process forked"""
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def _key_lock(self, symbol, interval):
+        with self._lock:
+            return self._locks.setdefault((symbol, interval), threading.Lock())
+
+    def _path(self, symbol, interval):
+        return os.path.join(self.root, interval, re.sub(r'[^A-Za-z0-9._-]', '_', symbol) + '.npy')
+
+    def _read(self, symbol, interval):
+        path = self._path(symbol, interval)
+        if not os.path.exists(path):
+            return None
+        records = np.load(path, mmap_mode='r')
+        if len(records) == 0:
+            return None
+        frame = pd.DataFrame(
+            {field: np.array(records[field]) for field in BAR_FIELDS},
+            index=pd.DatetimeIndex(np.array(records['ts']).view('datetime64[ns]'), name='Date')
+        )
+        del records  # release the mapping so the file can be replaced
+        if not frame['Volume'].isna().any():
+            frame['Volume'] = frame['Volume'].astype('int64')
+        return frame
+
+    def _write(self, symbol, interval, frame):
+        records = np.empty(len(frame), dtype=BAR_DTYPE)
+        records['ts'] = frame.index.values.astype('datetime64[ns]').view('i8')
+        for field in BAR_FIELDS:
+            records[field] = frame[field].to_numpy(dtype=float)
+
+        path = self._path(symbol, interval)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, records)
+        os.replace(tmp_path, path)  # readers see either the old or the new file
+
+def empty_history():
+    return pd.DataFrame(columns=BAR_FIELDS, index=pd.DatetimeIndex([], name='Date'))
+
+def normalize_history(frame):
+    """Keep only OHLCV columns and index bars by exchange-local, timezone-naive timestamps"""
+    if frame.empty:
+        return empty_history()
+    frame = frame[BAR_FIELDS].dropna(subset=['Close'])
+    if frame.index.tz is not None:
+        frame = frame.tz_localize(None)
+    return frame[~frame.index.duplicated(keep='last')].sort_index()
+
+bar_store = BarStore(BAR_STORE_DIR) if BAR_STORE_DIR else None
+
+@api.route('/api/cache/stats')
+def get_cache_stats():
+    return jsonify({
+        'status': 'success',
+        'data': {
+            **{name: cache.stats() for name, cache in cache_registry.items()},
+            'singleflight': {name: flight.stats() for name, flight in singleflight_registry.items()}
+        }
+    })
+
+# Technical indicators
+
+INDICATOR_SPANS = (20, 50, 200)
+INDICATOR_MAX_SPAN = 400
+VOLATILITY_WINDOW = 20
+RSI_PERIOD = 14
+INDICATOR_INTERVALS = {'days': '1d', 'weeks': '1d', 'months': '1d', 'years': '1wk'}
+PERIODS_PER_YEAR = {'1d': 252, '1wk': 52, '1mo': 12}
+CALENDAR_DAYS_PER_BAR = {'1d': 1.5, '1wk': 7.5, '1mo': 31}
+
+indicator_cache = TTLCache('indicators', INFO_CACHE_TTL)
+metrics.describe('indicator_updates_total', 'counter', 'Indicator computations by mode (full or incremental)')
+
+def parse_spans(value):
+    """Parse a comma-separated list of moving average spans, defaulting to INDICATOR_SPANS"""
+    if not value:
+        return INDICATOR_SPANS
+    spans = tuple(sorted({int(span) for span in value.split(',') if span.strip()}))
+    if not spans or len(spans) > 5 or spans[0] < 2 or spans[-1] > INDICATOR_MAX_SPAN:
+        raise ValueError(f'spans must be 1 to 5 integers between 2 and {INDICATOR_MAX_SPAN}')
+    return spans
+
+def load_indicators(symbol, window_size, window_unit, spans):
+    """
+    Compute indicator columns and a summary for a symbol over a trailing window. Bars
+    before the window are fetched as warm-up so every average is defined from its start.
+    """
+    interval = INDICATOR_INTERVALS.get(window_unit, '1d')
+    end_date = datetime.now()
+    start_date = end_date - get_time_delta(window_size, window_unit)
+    warmup_bars = max(max(spans), VOLATILITY_WINDOW + 1, RSI_PERIOD * 4)
+    warmup = timedelta(days=warmup_bars * CALENDAR_DAYS_PER_BAR[interval])
+    
+    df = fetch_history(symbol, interval=interval, start=start_date - warmup, end=end_date)
+    df = df[df['Close'].notna()]
+    if df.empty:
+        raise ValueError(f'No price data for {symbol}')
+    
+    # Reuse the previous computation for every bar that has not changed. EMA and RSI depend
+    # on every bar before them, so only a series seeded from the same first bar is reusable
+    ts = df.index.asi8
+    key = (symbol.upper(), interval, spans, int(ts[0]))
+    closes = df['Close'].to_numpy(dtype=float)
+    previous, resume = indicator_resume_point(indicator_cache.get(key), ts, closes)
+    series = compute_indicators(closes, spans, PERIODS_PER_YEAR[interval], previous, resume)
+    series['ts'] = ts
+    indicator_cache.set(key, series)
+    metrics.inc('indicator_updates_total', mode='incremental' if resume else 'full')
+    
+    # Drawdown is measured from the peak inside the requested window
+    first = min(int(np.searchsorted(df.index, pd.Timestamp(start_date, tz=df.index.tz))), len(df) - 1)
+    window = {name: values[first:] for name, values in series.items() if name not in ('ts', 'avg_gain', 'avg_loss')}
+    window['drawdown'] = drawdown(window['close'])
+    
+    columns = {'date': df.index[first:].strftime('%Y-%m-%d').tolist()}
+    for name, values in window.items():
+        columns[name] = [None if np.isnan(v) else v for v in np.round(values, 3).tolist()]
+    
+    summary = {name: values[-1] for name, values in columns.items() if name not in ('date', 'drawdown')}
+    summary.update({
+        'max_drawdown': convert_to_native_types(window['drawdown'].min()),
+        'spans': list(spans),
+        'volatility_window': VOLATILITY_WINDOW,
+        'rsi_period': RSI_PERIOD,
+        'window_size': window_size,
+        'window_unit': window_unit,
+        'interval_used': interval
+    })
+    return columns, summary
+
+def indicator_resume_point(previous, ts, closes):
+    """
+    Line a cached indicator series up with freshly fetched bars that start at the same bar.
+    Returns the cached values for the unchanged bars and the first position whose bar is
+    new or changed (0 to recompute everything). The last bar is usually still forming, so
+    it tends to be redone.
+    """
+    if previous is None or len(ts) == 0 or previous['ts'][0] != ts[0]:
+        return None, 0
+    overlap = min(len(previous['ts']), len(ts))
+    same = (previous['ts'][:overlap] == ts[:overlap]) & (previous['close'][:overlap] == closes[:overlap])
+    resume = overlap if same.all() else int(np.argmin(same))
+    if resume < 2:
+        return None, 0
+    return {name: values[:resume] for name, values in previous.items()}, resume
+
+def compute_indicators(closes, spans, periods_per_year, previous=None, resume=0):
+    """
+    SMA and EMA per span, annualized rolling volatility (percent) and RSI for a close
+    series. Values before resume are copied from previous, so only new bars are computed.
+    """
+    n = len(closes)
+    rolling_from = lambda window: max(resume - window + 1, 0)
+    returns = np.concatenate([[np.nan], np.diff(np.log(closes))])
+    changes = np.concatenate([[np.nan], np.diff(closes)])
+    series = {'close': closes}
+    
+    for span in spans:
+        start = rolling_from(span)
+        series[f'sma_{span}'] = rolling_mean(closes[start:], span)[resume - start:]
+        seed = previous[f'ema_{span}'][-1] if resume else None
+        series[f'ema_{span}'] = ema(closes[resume:], 2 / (span + 1), seed)
+    
+    start = rolling_from(VOLATILITY_WINDOW)
+    series['volatility'] = rolling_std(returns[start:], VOLATILITY_WINDOW)[resume - start:] * np.sqrt(periods_per_year) * 100
+    
+    # Wilder's RSI smooths gains and losses with alpha = 1 / period
+    first = max(resume, 1)
+    gains, losses = np.maximum(changes[first:], 0), np.maximum(-changes[first:], 0)
+    series['avg_gain'] = ema(gains, 1 / RSI_PERIOD, previous['avg_gain'][-1] if resume else None)
+    series['avg_loss'] = ema(losses, 1 / RSI_PERIOD, previous['avg_loss'][-1] if resume else None)
+    if not resume:
+        series['avg_gain'] = np.concatenate([[np.nan], series['avg_gain']])[:n]
+        series['avg_loss'] = np.concatenate([[np.nan], series['avg_loss']])[:n]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        series['rsi'] = np.where(series['avg_loss'] == 0, 100.0,
+                                 100 - 100 / (1 + series['avg_gain'] / series['avg_loss']))
+    series['rsi'][np.isnan(series['avg_gain'])] = np.nan
+    
+    if resume:
+        for name, values in series.items():
+            if name != 'close':
+                series[name] = np.concatenate([previous[name], values])
+    return series
+
+def rolling_mean(values, window):
+    """Trailing mean over window values from a cumulative sum, NaN until the window fills"""
+    out = np.full(len(values), np.nan)
+    if len(values) >= window:
+        sums = np.cumsum(np.concatenate([[0.0], values]))
+        out[window - 1:] = (sums[window:] - sums[:-window]) / window
+    return out
+
+def rolling_std(values, window):
+    """Trailing sample standard deviation over window values, NaN until the window fills"""
+    out = np.full(len(values), np.nan)
+    if len(values) >= window:
+        out[window - 1:] = np.lib.stride_tricks.sliding_window_view(values, window).std(axis=1, ddof=1)
+    return out
+
+def ema(values, alpha, seed=None):
+    """
+    Exponential moving average y[t] = alpha * x[t] + (1 - alpha) * y[t-1], seeded with
+    y[-1] = seed (x[0] by default). Each block is evaluated in closed form as a scaled
+    cumulative sum; blocks stay short enough that the scale factors fit in a float.
+    """
+    values = np.asarray(values, dtype=float)
+    out = np.empty(len(values))
+    if len(values) == 0:
+        return out
+    decay = 1 - alpha
+    if decay <= 0:
+        return values.copy()
+    previous = values[0] if seed is None else seed
+    block = max(int(np.log(1e12) / -np.log(decay)), 1)
+    for start in range(0, len(values), block):
+        chunk = values[start:start + block]
+        powers = decay ** np.arange(len(chunk))
+        out[start:start + len(chunk)] = powers * (decay * previous + alpha * np.cumsum(chunk / powers))
+        previous = out[start + len(chunk) - 1]
+    return out
+
+def drawdown(closes):
+    """Percent below the running peak at every bar"""
+    return (closes / np.maximum.accumulate(closes) - 1) * 100
+
+# Chart downsampling
+
+CHART_INTERVAL = '1d'
+CHART_MAX_POINTS = 2000
+
+chart_cache = TTLCache('charts', PRICE_CACHE_TTL)
+
+def bucket_matrix(edges, n):
+    """
+    Index matrix with one row per bucket [edges[i], edges[i + 1]), padded to the widest
+    bucket, plus a mask of the real entries, so every bucket can be reduced at once.
+    """
+    starts, ends = edges[:-1], edges[1:]
+    index = starts[:, np.newaxis] + np.arange(max(int((ends - starts).max()), 1))
+    mask = index < ends[:, np.newaxis]
+    return np.minimum(index, n - 1), mask
+
+def lttb_indices(values, max_points):
+    """
+    Largest-Triangle-Three-Buckets: keep the first and last points and, from each bucket
+    in between, the point forming the largest triangle with its neighbouring buckets.
+    Neighbours are represented by their bucket averages (rather than the point already
+    chosen on the left) so all buckets are scored in one vectorized pass.
+    """
+    n = len(values)
+    if n <= max_points:
+        return np.arange(n)
+    positions = np.arange(n, dtype=float)
+    index, mask = bucket_matrix(np.linspace(1, n - 1, max_points - 1).astype(int), n)
+    counts = mask.sum(axis=1)
+    avg_x = np.where(mask, positions[index], 0).sum(axis=1) / counts
+    avg_y = np.where(mask, values[index], 0).sum(axis=1) / counts
+    
+    # Triangle anchors: the previous and next bucket averages, or the fixed end points
+    ax, ay = np.concatenate([[0.0], avg_x[:-1]]), np.concatenate([[values[0]], avg_y[:-1]])
+    cx, cy = np.concatenate([avg_x[1:], [n - 1.0]]), np.concatenate([avg_y[1:], [values[-1]]])
+    area = np.abs((ax - cx)[:, np.newaxis] * (values[index] - ay[:, np.newaxis])
+                  - (ax[:, np.newaxis] - positions[index]) * (cy - ay)[:, np.newaxis])
+    area[~mask] = -1
+    chosen = index[np.arange(len(index)), area.argmax(axis=1)]
+    return np.concatenate([[0], chosen, [n - 1]])
+
+def minmax_indices(values, max_points):
+    """Keep the lowest and highest point of each bucket (plus both ends), in time order"""
+    n = len(values)
+    if n <= max_points:
+        return np.arange(n)
+    buckets = max((max_points - 2) // 2, 1)
+    index, mask = bucket_matrix(np.linspace(0, n, buckets + 1).astype(int), n)
+    rows = np.arange(buckets)
+    lows = index[rows, np.where(mask, values[index], np.inf).argmin(axis=1)]
+    highs = index[rows, np.where(mask, values[index], -np.inf).argmax(axis=1)]
+    return np.unique(np.concatenate([[0, n - 1], lows, highs]))
+
+DOWNSAMPLERS = {
+    'lttb': lttb_indices,
+    'minmax': minmax_indices,
+}
+
+# Multi-symbol comparison
+
+COMPARE_MAX_SYMBOLS = int(os.environ.get('COMPARE_MAX_SYMBOLS', 20))
+
+def load_comparison(symbols, window_size, window_unit):
+    """
+    Fetch every symbol in one batch, align the closes on a shared date index and compute
+    normalized curves, the return correlation matrix and per-symbol stats over the window.
+    """
+    interval = INDICATOR_INTERVALS.get(window_unit, '1d')
+    start_date = datetime.now() - get_time_delta(window_size, window_unit)
+    frame = fetch_history_batch(symbols, period=covering_period(start_date), interval=interval)
+    if frame.empty:
+        raise ValueError('No price data for any symbol')
+    
+    # Align on the union of trading dates in the window, carrying the last close over gaps
+    prices, dates = close_matrix(frame, symbols)
+    first = int(np.searchsorted(dates, pd.Timestamp(start_date, tz=dates.tz)))
+    prices, dates = prices[:, first:], dates[first:]
+    available = ~np.isnan(prices).all(axis=1)
+    missing = [symbol for symbol, ok in zip(symbols, available) if not ok]
+    symbols, prices = [symbol for symbol, ok in zip(symbols, available) if ok], prices[available]
+    if len(symbols) == 0:
+        raise ValueError('No price data for any symbol')
+    
+    # Returns come from the unfilled closes, so a day a symbol did not trade adds no zero return
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.diff(np.log(prices), axis=1)
+    prices = pd.DataFrame(prices.T).ffill().to_numpy().T
+    
+    stats = compare_stats(prices, returns, PERIODS_PER_YEAR[interval])
+    
+    # Curves are percent change from each symbol's first close in the window
+    base = prices[np.arange(len(symbols)), np.argmax(~np.isnan(prices), axis=1)]
+    curves = np.round((prices / base[:, np.newaxis] - 1) * 100, 3)
+    
+    # Correlate log returns over the dates where every symbol traded (on that day and the one before)
+    complete = returns[:, ~np.isnan(returns).any(axis=0)]
+    if complete.shape[1] >= 2:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation = np.round(np.atleast_2d(np.corrcoef(complete)), 3)
+    else:
+        correlation = np.full((len(symbols), len(symbols)), np.nan)
+    
+    nan_to_none = lambda rows: [[None if np.isnan(v) else v for v in row] for row in rows.tolist()]
+    return {
+        'data': {
+            'dates': dates.strftime('%Y-%m-%d').tolist(),
+            'series': dict(zip(symbols, nan_to_none(curves)))
+        },
+        'correlation': {'symbols': symbols, 'matrix': nan_to_none(correlation)},
+        'stats': {symbol: {name: convert_to_native_types(values[i]) for name, values in stats.items()}
+                  for i, symbol in enumerate(symbols)},
+        'missing_symbols': missing,
+        'window_size': window_size,
+        'window_unit': window_unit,
+        'interval_used': interval
+    }
+
+def compare_stats(prices, returns, periods_per_year):
+    """
+    Per-row stats for a forward-filled (symbols x days) close matrix and the log returns of
+    the unfilled closes (NaN where a symbol did not trade), in percent where relative
+    """
+    rows = np.arange(len(prices))
+    valid = ~np.isnan(prices)
+    start_price = prices[rows, np.argmax(valid, axis=1)]
+    end_price = prices[:, -1]
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        peaks = np.fmax.accumulate(prices, axis=1)
+        return {
+            'start_price': start_price,
+            'end_price': end_price,
+            'total_return': (end_price / start_price - 1) * 100,
+            'volatility': np.nanstd(returns, axis=1, ddof=1) * np.sqrt(periods_per_year) * 100,
+            'max_drawdown': np.nanmin(prices / peaks - 1, axis=1) * 100,
+            'high': np.nanmax(prices, axis=1),
+            'low': np.nanmin(prices, axis=1)
+        }
+
+def covering_period(start_date):
+    """Shortest Yahoo period string that reaches back to start_date"""
+    now = pd.Timestamp.now().normalize()
+    for period, offset in PERIOD_OFFSETS.items():
+        if now - pd.DateOffset(**offset) <= pd.Timestamp(start_date):
+            return period
+    return 'max'
+
+# Watchlists
+
+WATCHLIST_MAX_SYMBOLS = int(os.environ.get('WATCHLIST_MAX_SYMBOLS', 100))
+
+def get_watchlists():
+    """Get the watchlists collection, creating its unique per-user index on first use"""
+    return get_indexed_collection('watchlists', lambda collection: collection.create_index('user', unique=True))
+
+def clean_symbols(symbols):
+    """Upper-case, de-duplicate and bound a list of ticker symbols, keeping their order"""
+    if not isinstance(symbols, list) or not all(isinstance(symbol, str) for symbol in symbols):
+        raise ValueError('symbols must be a list of ticker strings')
+    symbols = list(dict.fromkeys(symbol.strip().upper() for symbol in symbols if symbol.strip()))
+    if len(symbols) > WATCHLIST_MAX_SYMBOLS:
+        raise ValueError(f'A watchlist holds at most {WATCHLIST_MAX_SYMBOLS} symbols')
+    return symbols
+
+def load_watchlist(user):
+    with timed_stage('mongo'):
+        document = get_watchlists().find_one({'user': user}, {'_id': 0, 'symbols': 1})
+    return document['symbols'] if document else []
+
+@api.route('/api/watchlist/<user>', methods=['GET'])
+def get_watchlist(user):
+    try:
+        return jsonify({'status': 'success', 'user': user, 'symbols': load_watchlist(user)})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+@api.route('/api/watchlist/<user>', methods=['PUT'])
+def replace_watchlist(user):
+    try:
+        symbols = clean_symbols((request.json or {}).get('symbols'))
+        with timed_stage('mongo'):
+            get_watchlists().update_one(
+                {'user': user},
+                {'$set': {'symbols': symbols, 'updated_at': datetime.utcnow()}},
+                upsert=True
+            )
+        return jsonify({'status': 'success', 'user': user, 'symbols': symbols})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+@api.route('/api/watchlist/<user>/symbols', methods=['POST'])
+def add_watchlist_symbol(user):
+    try:
+        symbol = clean_symbols([(request.json or {}).get('symbol') or ''])
+        if not symbol:
+            raise ValueError('symbol is required')
+        current = load_watchlist(user)
+        if symbol[0] not in current and len(current) >= WATCHLIST_MAX_SYMBOLS:
+            raise ValueError(f'A watchlist holds at most {WATCHLIST_MAX_SYMBOLS} symbols')
+        with timed_stage('mongo'):
+            get_watchlists().update_one(
+                {'user': user},
+                {'$addToSet': {'symbols': symbol[0]}, '$set': {'updated_at': datetime.utcnow()}},
+                upsert=True
+            )
+        return jsonify({'status': 'success', 'user': user, 'symbols': load_watchlist(user)})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+@api.route('/api/watchlist/<user>/symbols/<symbol>', methods=['DELETE'])
+def remove_watchlist_symbol(user, symbol):
+    try:
+        with timed_stage('mongo'):
+            get_watchlists().update_one(
+                {'user': user},
+                {'$pull': {'symbols': symbol.upper()}, '$set': {'updated_at': datetime.utcnow()}}
+            )
+        return jsonify({'status': 'success', 'user': user, 'symbols': load_watchlist(user)})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+@api.route('/api/watchlist/<user>/quotes', methods=['GET'])
+def get_watchlist_quotes(user):
+    try:
+        symbols = load_watchlist(user)
+        return api_response({
+            'status': 'success',
+            'user': user,
+            'data': watchlist_quotes(symbols) if symbols else []
+        })
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+def watchlist_quotes(symbols):
+    """
+    Value every symbol from one batched month of daily closes (served from the history
+    cache and bar store when warm): current price, change since the previous close and
+    monthly return, computed for all symbols at once. Symbols without data get None.
+    """
+    frame = fetch_history_batch(symbols, period='1mo')
+    if frame.empty:
+        return [{'symbol': symbol, 'as_of': None, 'current_price': None, 'daily_change': None,
+                 'daily_change_percent': None, 'monthly_return': None} for symbol in symbols]
+    prices, dates = close_matrix(frame, symbols)
+    prices = pd.DataFrame(prices.T).ffill().to_numpy().T
+    n_days = prices.shape[1]
+    
+    rows = np.arange(len(symbols))
+    current = prices[:, -1] if n_days else np.full(len(symbols), np.nan)
+    previous = prices[:, -2] if n_days > 1 else np.full(len(symbols), np.nan)
+    first = prices[rows, np.argmax(~np.isnan(prices), axis=1)] if n_days else np.full(len(symbols), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        columns = {
+            'current_price': current,
+            'daily_change': current - previous,
+            'daily_change_percent': (current / previous - 1) * 100,
+            'monthly_return': (current / first - 1) * 100,
+        }
+    as_of = dates[-1].strftime('%Y-%m-%d') if n_days else None
+    
+    # Round and convert whole columns, then zip them into one dict per symbol
+    columns = {name: [None if np.isnan(v) else v for v in np.round(values, 3).tolist()]
+               for name, values in columns.items()}
+    return [{'symbol': symbol, 'as_of': as_of, **dict(zip(columns, row))}
+            for symbol, row in zip(symbols, zip(*columns.values()))]
+
+# Spending transactions
+
+TRANSACTION_BATCH_MAX = int(os.environ.get('TRANSACTION_BATCH_MAX', 5000))
+
+def get_transactions():
+    """Get the transactions collection, creating its indexes on first use"""
+    def create(collection):
+        collection.create_index([('user', 1), ('month', 1)])
+        # Client supplied ids make retried uploads idempotent
+        collection.create_index([('user', 1), ('txn_id', 1)], unique=True,
+                                partialFilterExpression={'txn_id': {'$exists': True}})
+    return get_indexed_collection('transactions', create)
+
+def get_rollups():
+    """Get the per-user monthly spending rollups, one document per (user, month)"""
+    return get_indexed_collection('spending_rollups',
+                                  lambda collection: collection.create_index([('user', 1), ('month', 1)], unique=True))
+
+def category_key(category):
+    """Make a category usable as a Mongo field name"""
+    return re.sub(r'[.$]', '_', str(category).strip() or 'Uncategorized')
+
+def parse_transaction(user, item):
+    """Validate one uploaded transaction and shape it for storage (amounts kept in cents)"""
+    if not isinstance(item, dict):
+        raise ValueError('each transaction must be an object')
+    amount_cents = int(round(float(item['amount']) * 100))
+    date = datetime.fromisoformat(item['date']) if item.get('date') else datetime.utcnow()
+    document = {
+        'user': user,
+        'amount_cents': amount_cents,
+        'category': category_key(item.get('category', 'Uncategorized')),
+        'description': item.get('description', ''),
+        'date': date,
+        'month': date.strftime('%Y-%m')
+    }
+    if item.get('id') is not None:
+        document['txn_id'] = str(item['id'])
+    return document
+
+def rollup_increments(documents):
+    """Sum a batch of transactions into one $inc per (user, month)"""
+    increments = defaultdict(lambda: defaultdict(int))
+    for document in documents:
+        inc = increments[(document['user'], document['month'])]
+        inc['total_cents'] += document['amount_cents']
+        inc['count'] += 1
+        inc[f"categories.{document['category']}.total_cents"] += document['amount_cents']
+        inc[f"categories.{document['category']}.count"] += 1
+    return increments
+
+@api.route('/api/transactions/<user>', methods=['POST'])
+def ingest_transactions(user):
+    try:
+        items = (request.json or {}).get('transactions')
+        if not isinstance(items, list) or not 1 <= len(items) <= TRANSACTION_BATCH_MAX:
+            raise ValueError(f'transactions must be a list of 1 to {TRANSACTION_BATCH_MAX} items')
+        documents = [parse_transaction(user, item) for item in items]
+        
+        # The inserts and their rollup increments commit together or not at all
+        with timed_stage('mongo'):
+            with get_db().client.start_session() as session:
+                inserted = session.with_transaction(lambda session: store_transactions(user, documents, session))
+        
+        return jsonify({
+            'status': 'success',
+            'inserted': len(inserted),
+            'duplicates': len(documents) - len(inserted)
+        })
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+def store_transactions(user, documents, session):
+    """
+    Insert the transactions whose ids are not stored yet and fold them into the rollups,
+    inside session's transaction. Returns the inserted documents.
+    """
+    from pymongo import UpdateOne
+    
+    # Skip ids that are already stored (a retried upload) or repeated in the batch, since a
+    # duplicate key error would abort the whole transaction
+    ids = [document['txn_id'] for document in documents if 'txn_id' in document]
+    seen = {document['txn_id'] for document in get_transactions().find(
+        {'user': user, 'txn_id': {'$in': ids}}, {'txn_id': 1, '_id': 0}, session=session)} if ids else set()
+    inserted = []
+    for document in documents:
+        if 'txn_id' in document:
+            if document['txn_id'] in seen:
+                continue
+            seen.add(document['txn_id'])
+        inserted.append(document)
+    if not inserted:
+        return inserted
+    
+    get_transactions().insert_many(inserted, ordered=False, session=session)
+    
+    # Fold the batch into the rollups with one $inc per touched month
+    now = datetime.utcnow()
+    get_rollups().bulk_write([
+        UpdateOne({'user': rollup_user, 'month': month},
+                  {'$inc': dict(increments), '$set': {'updated_at': now}}, upsert=True)
+        for (rollup_user, month), increments in rollup_increments(inserted).items()
+    ], session=session)
+    return inserted
+
+@api.route('/api/transactions/<user>/summary', methods=['GET'])
+def get_spending_summary(user):
+    try:
+        # Trailing months ending at ?month=YYYY-MM (default: this month)
+        months = request.args.get('months', default=6, type=int)
+        end = pd.Period(request.args.get('month') or datetime.utcnow().strftime('%Y-%m'), freq='M')
+        start = str(end - (max(months, 1) - 1))
+        
+        with timed_stage('mongo'):
+            rollups = list(get_rollups().find(
+                {'user': user, 'month': {'$gte': start, '$lte': str(end)}},
+                {'_id': 0, 'user': 0}
+            ).sort('month', 1))
+        
+        return jsonify({
+            'status': 'success',
+            'user': user,
+            'data': [rollup_summary(rollup) for rollup in rollups]
+        })
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+def rollup_summary(rollup):
+    """Present a rollup document in currency units"""
+    return {
+        'month': rollup['month'],
+        'total': rollup.get('total_cents', 0) / 100,
+        'count': rollup.get('count', 0),
+        'categories': {
+            category: {'total': values.get('total_cents', 0) / 100, 'count': values.get('count', 0)}
+            for category, values in rollup.get('categories', {}).items()
+        }
+    }
+
+@api.cli.command('backfill-rollups')
+@click.option('--user', default=None, help='Only rebuild this user\'s rollups')
+def backfill_rollups(user):
+    """Rebuild spending rollups from the stored transactions"""
+    from pymongo import ReplaceOne
+    
+    match = {'user': user} if user else {}
+    pipeline = [
+        {'$match': match},
+        {'$group': {
+            '_id': {'user': '$user', 'month': '$month', 'category': '$category'},
+            'total_cents': {'$sum': '$amount_cents'},
+            'count': {'$sum': 1}
+        }}
+    ]
+    rollups = {}
+    for row in get_transactions().aggregate(pipeline, allowDiskUse=True):
+        key = (row['_id']['user'], row['_id']['month'])
+        rollup = rollups.setdefault(key, {'user': key[0], 'month': key[1], 'total_cents': 0, 'count': 0,
+                                          'categories': {}})
+        rollup['total_cents'] += row['total_cents']
+        rollup['count'] += row['count']
+        rollup['categories'][row['_id']['category']] = {'total_cents': row['total_cents'], 'count': row['count']}
+    
+    # Replace whole documents so the rebuilt totals are exact, then drop months with no data left
+    now = datetime.utcnow()
+    writes = [ReplaceOne({'user': rollup['user'], 'month': rollup['month']}, {**rollup, 'updated_at': now},
+                            upsert=True) for rollup in rollups.values()]
+    for batch in chunked(writes, 1000):
+        get_rollups().bulk_write(batch, ordered=False)
+    stale = {key for key in ((d['user'], d['month']) for d in get_rollups().find(match, {'user': 1, 'month': 1}))
+             if key not in rollups}
+    for stale_user, month in stale:
+        get_rollups().delete_one({'user': stale_user, 'month': month})
+    click.echo(f'Rebuilt {len(rollups)} rollups, removed {len(stale)}')
+
+# Tips retrieval index
+
+CHAT_REMOTE_RERANK = os.environ.get('CHAT_REMOTE_RERANK', '0').lower() in ('1', 'true', 'yes')
+CHAT_RERANK_CANDIDATES = int(os.environ.get('CHAT_RERANK_CANDIDATES', 10))
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'do', 'for', 'from', 'how', 'i', 'if', 'in',
+    'into', 'is', 'it', 'my', 'of', 'on', 'or', 'should', 'so', 'that', 'the', 'this', 'to', 'what',
+    'when', 'where', 'which', 'while', 'who', 'why', 'will', 'with', 'you', 'your',
+}
+
+def tokenize(text):
+    """Lowercase, split on non-alphanumerics, drop stopwords and strip common suffixes"""
+    tokens = []
+    for token in re.findall(r'[a-z0-9]+', text.lower()):
+        if token in STOPWORDS:
+            continue
+        for suffix in ('ing', 'ies', 'es', 'ed', 's'):
+            if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+                token = token[:-len(suffix)] + ('y' if suffix == 'ies' else '')
+                break
+        tokens.append(token)
+    return tokens
+
+class TipsIndex:
+    """
+    BM25 index over the tips corpus. Term weights are precomputed into a dense
+    (docs x terms) matrix, so scoring a query is one matrix-vector product.
+    """
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.texts = [f"{doc['data']['title']}\n{doc['data']['text']}" for doc in documents]
+        doc_tokens = [tokenize(text) for text in self.texts]
+        self.vocabulary = {term: i for i, term in enumerate(sorted({t for tokens in doc_tokens for t in tokens}))}
+        
+        term_counts = np.zeros((len(documents), len(self.vocabulary)), dtype=np.float32)
+        for row, tokens in enumerate(doc_tokens):
+            np.add.at(term_counts[row], [self.vocabulary[t] for t in tokens], 1)
+        
+        doc_lengths = term_counts.sum(axis=1, keepdims=True)
+        length_norm = 1 - b + b * doc_lengths / max(doc_lengths.mean(), 1)
+        doc_freq = (term_counts > 0).sum(axis=0)
+        idf = np.log(1 + (len(documents) - doc_freq + 0.5) / (doc_freq + 0.5))
+        self.weights = (idf * term_counts * (k1 + 1) / (term_counts + k1 * length_norm)).astype(np.float32)
+
+    def search(self, query, top_k):
+        """
+        Return [(document index, score)] for the top_k documents, best first. Weak or
+        unmatched queries are padded with the next-best documents (in corpus order on
+        ties), so chat replies are always grounded on top_k tips.
+        """
+        if top_k <= 0:
+            return []
+        term_ids = [self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary]
+        query_vector = np.bincount(term_ids, minlength=len(self.vocabulary)).astype(np.float32)
+        scores = self.weights @ query_vector
+        
+        # The corpus is small, so a stable full sort keeps tied (zero) scores deterministic
+        top = np.argsort(-scores, kind='stable')[:top_k]
+        return [(int(idx), float(scores[idx])) for idx in top]
+
+tips_index = None
+tips_index_lock = threading.Lock()
+
+def get_tips_index(documents):
+    """Get the index for documents, rebuilding it only when the titles or texts change"""
+    global tips_index
+    fingerprint = data_version([(doc['data']['title'], doc['data']['text']) for doc in documents])
+    with tips_index_lock:
+        if tips_index is None or tips_index[0] != fingerprint:
+            tips_index = (fingerprint, TipsIndex(documents))
+        return tips_index[1]
+
+# Chat response cache
+
+CHAT_CACHE_TTL = int(os.environ.get('CHAT_CACHE_TTL', 3600))  # seconds
+CHAT_CACHE_MAX_ENTRIES = int(os.environ.get('CHAT_CACHE_MAX_ENTRIES', 1000))
+CHAT_CACHE_SIMILARITY = float(os.environ.get('CHAT_CACHE_SIMILARITY', 0))  # cosine threshold, 0 disables
+CHAT_EMBED_MODEL = os.environ.get('CHAT_EMBED_MODEL', 'embed-english-light-v3.0')
+
+def normalize_query(query):
+    """Lowercase a query and collapse punctuation and whitespace"""
+    return ' '.join(re.findall(r'[a-z0-9]+', (query or '').lower()))
+
+class ChatResponseCache(TTLCache):
+    """
+    Chat replies keyed by (normalized query, retrieved document titles). When
+    CHAT_CACHE_SIMILARITY is set, a miss falls back to the most similar cached query
+    over the same documents, compared by cosine similarity of Cohere embeddings.
+    """
+
+    def __init__(self, name, ttl, max_entries, similarity):
+        super().__init__(name, ttl, max_entries=max_entries)
+        self.similarity = similarity
+        self.similar_hits = 0
+        self._embeddings = OrderedDict()  # key -> unit-length query embedding
+
+    def lookup(self, query, relevant_docs):
+        """Return (cached result or None, cache metadata for the response), counted as one hit or miss"""
+        result, info = self._lookup(query, relevant_docs)
+        with self._lock:
+            self._count(result is not None)
+            if info.get('match') == 'similar':
+                self.similar_hits += 1
+        return result, info
+
+    def _lookup(self, query, relevant_docs):
+        key = self._key(query, relevant_docs)
+        result = self.get(key, count=False)
+        if result is not None:
+            return result, {'hit': True, 'match': 'exact'}
+        if self.similarity <= 0:
+            return None, {'hit': False}
+
+        embedding = embed_query(query)
+        if embedding is None:
+            return None, {'hit': False}
+        with self._lock:
+            candidates = [(k, v) for k, v in self._embeddings.items() if k[1] == key[1]]
+        if candidates:
+            scores = np.stack([v for _, v in candidates]) @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] >= self.similarity:
+                result = self.get(candidates[best][0], count=False)
+                if result is not None:
+                    return result, {'hit': True, 'match': 'similar', 'similarity': round(float(scores[best]), 4)}
+        return None, {'hit': False, 'embedding': embedding}
+
+    def store(self, query, relevant_docs, result, embedding=None):
+        key = self._key(query, relevant_docs)
+        self.set(key, result)
+        if embedding is not None:
+            with self._lock:
+                self._embeddings[key] = embedding
+                self._embeddings.move_to_end(key)
+                while len(self._embeddings) > self.max_entries:
+                    self._embeddings.popitem(last=False)
+
+    def stats(self):
+        return {**super().stats(), 'similar_hits': self.similar_hits}
+
+    def _key(self, query, relevant_docs):
+        return normalize_query(query), tuple(doc['data']['title'] for doc in relevant_docs)
+
+def embed_query(query):
+    """Embed a query with Cohere as a unit-length vector, or None if that fails"""
+    try:
+        with timed_stage('cohere_embed'):
+            response = get_cohere_client().embed(
+                texts=[query],
+                model=CHAT_EMBED_MODEL,
+                input_type='search_query',
+                embedding_types=['float']
+            )
+        vector = np.asarray(response.embeddings.float_[0], dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+    except Exception as e:
+        print(f"Error embedding query: {str(e)}")
+        return None
+
+chat_cache = ChatResponseCache('chat', CHAT_CACHE_TTL, CHAT_CACHE_MAX_ENTRIES, CHAT_CACHE_SIMILARITY)
+
+# Precomputed leaderboard snapshots
+
+SNAPSHOT_REFRESH_SECONDS = int(os.environ.get('SNAPSHOT_REFRESH_SECONDS', 300))
+
+class SnapshotScheduler:
+    """
+    Rebuilds named payloads on a background thread and serves the latest good copy
+    (stale-while-revalidate). A failed refresh keeps the previous snapshot. With an
+    interval of 0 or less, snapshots are rebuilt on every request instead.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._builders = {}
+        self._build_locks = {}
+        self._snapshots = {}  # name -> {'data', 'generated_at', 'error'}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def register(self, name, builder):
+        self._builders[name] = builder
+        self._build_locks[name] = threading.Lock()
+
+    def get(self, name):
+        """Return the latest snapshot, building it inline if none exists yet"""
+        if self.interval <= 0:
+            return self.refresh(name)
+        self.start()
+        snapshot = self._snapshots.get(name)
+        if snapshot is None:
+            snapshot = self.refresh(name)
+        return snapshot
+
+    def refresh(self, name):
+        """Rebuild one snapshot; concurrent callers share a single build"""
+        requested_at = time.time()
+        with self._build_locks[name]:
+            snapshot = self._snapshots.get(name)
+            if snapshot is not None and snapshot['generated_at'] >= requested_at:
+                return snapshot
+            try:
+                snapshot = {'data': self._builders[name](), 'generated_at': time.time(), 'error': None}
+            except Exception as e:
+                print(f"Error refreshing {name} snapshot: {str(e)}")
+                if snapshot is None:
+                    raise
+                snapshot = {**snapshot, 'error': str(e)}
+            self._snapshots[name] = snapshot
+            return snapshot
+
+    def refresh_all(self):
+        """Build every registered snapshot once, without starting the refresh thread"""
+        for name in self._builders:
+            try:
+                self.refresh(name)
+            except Exception as e:
+                print(f"Error building {name} snapshot: {str(e)}")
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._build_locks = {name: threading.Lock() for name in self._builders}
+
+    def ages(self):
+        """Seconds since each snapshot was generated"""
+        now = time.time()
+        return {name: now - snapshot['generated_at'] for name, snapshot in self._snapshots.items()}
+
+    def start(self):
+        """Start the refresh thread (again, if this process was forked after it started)"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, args=(get_app(),), name='snapshot-scheduler',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self, flask_app):
+        # Builders read clients such as a mongo: universe from the app that started the thread
+        flask_app.app_context().push()
+        upstream_priority.set('background')
+        while True:
+            time.sleep(self.interval)
+            for name in self._builders:
+                try:
+                    self.refresh(name)
+                except Exception:
+                    pass  # already logged, retried on the next tick
+
+leaderboard_snapshots = SnapshotScheduler(SNAPSHOT_REFRESH_SECONDS)
+leaderboard_snapshots.register('top_performers', build_top_performers)
+leaderboard_snapshots.register('top_funds', build_top_funds)
+
+# App factory and upstream clients
+
+clients_lock = threading.Lock()
+
+def create_app(config=None):
+    """
+    Create the Flask app. Settings come from the environment (and .env) unless given in
+    config; passing COHERE_CLIENT or MONGO_DB injects ready-made clients instead. Each app
+    keeps its own clients. Nothing heavy is imported or connected here, see warmup().
+    """
+    flask_app = Flask(__name__)
+    flask_app.config.update(
+        MONGODB_URI=os.environ.get('MONGODB_URI'),
+        MONGO_DB_NAME=os.environ.get('MONGO_DB_NAME', 'test'),
+        COHERE_KEY=os.environ.get('COHERE_KEY'),
+        COHERE_CLIENT=None,
+        MONGO_DB=None,
+        WARMUP=False
+    )
+    flask_app.config.update(config or {})
+
+    CORS(flask_app, supports_credentials=True)
+    flask_app.register_blueprint(api)
+
+    flask_app.extensions['clients'] = injected_clients(flask_app)
+    flask_app.extensions['indexed_collections'] = set()
+
+    if flask_app.config['WARMUP']:
+        with flask_app.app_context():
+            warmup()
+    return flask_app
+
+def injected_clients(flask_app):
+    """The clients passed in through config, which are kept across forks"""
+    return {name: flask_app.config[key] for name, key in (('db', 'MONGO_DB'), ('cohere', 'COHERE_CLIENT'))
+            if flask_app.config[key] is not None}
+
+def get_app():
+    """The app handling this request or CLI command, else the default app (background threads)"""
+    return current_app._get_current_object() if has_app_context() else app
+
+def get_client(name, factory):
+    flask_app = get_app()
+    clients = flask_app.extensions['clients']
+    with clients_lock:
+        if name not in clients:
+            clients[name] = factory(flask_app.config)
+        return clients[name]
+
+def get_db():
+    """Get the Mongo database, connecting on first use"""
+    def connect(config):
+        from pymongo import MongoClient
+        return MongoClient(config['MONGODB_URI'])[config['MONGO_DB_NAME']]
+    return get_client('db', connect)
+
+def get_cohere_client():
+    """Get the Cohere client, constructing it on first use"""
+    return get_client('cohere', lambda config: cohere.ClientV2(api_key=config['COHERE_KEY']))
+
+def get_indexed_collection(name, create_indexes):
+    """Get a collection, running create_indexes(collection) the first time this app uses it"""
+    collection = get_db()[name]
+    indexed = get_app().extensions['indexed_collections']
+    if name not in indexed:
+        with timed_stage('mongo'):
+            create_indexes(collection)
+        indexed.add(name)
+    return collection
+
+def warmup(snapshots=False):
+    """
+    Import heavy modules and build in-memory indexes ahead of the first request. With
+    snapshots, also build the leaderboards so forked workers start with a copy of them.
+    """
+    for module in (np, pd, yf, cohere):
+        module._import()
+    get_tips_index(documents)
+    global upstream_executor
+    if snapshots:
+        token = upstream_priority.set('background')
+        try:
+            leaderboard_snapshots.refresh_all()
+        finally:
+            upstream_priority.reset(token)
+        # Wait for calls the fan-out deadline abandoned, so none is still in flight when workers fork
+        upstream_executor.shutdown(wait=True)
+        upstream_executor = create_upstream_executor()
+
+def after_fork(workers=1):
+    """
+    Give a forked worker its own upstream session, thread pool, clients and locks. Pooled
+    connections and threads from the parent do not survive fork, so neither do the locks
+    they held or the calls they had in flight; injected clients are kept. The worker's
+    upstream scheduler starts empty and gets 1/workers of the server's Yahoo rate limit.
+    """
+    global upstream_session, upstream_executor, upstream_scheduler, download_lock, tips_index_lock, clients_lock
+    upstream_session = create_upstream_session()
+    upstream_executor = create_upstream_executor()
+    upstream_scheduler = create_upstream_scheduler(workers)
+    download_lock = threading.Lock()
+    tips_index_lock = threading.Lock()
+    clients_lock = threading.Lock()
+    for flight in singleflight_registry.values():
+        flight.after_fork()
+    for cache in cache_registry.values():
+        cache.after_fork()
+    if bar_store is not None:
+        bar_store.after_fork()
+    metrics.after_fork()
+    leaderboard_snapshots.after_fork()
+    with clients_lock:
+        app.extensions['clients'] = injected_clients(app)
+
+app = create_app()
+
 if __name__ == '__main__':
 
     # just for the sake of testing, feel free to delete later
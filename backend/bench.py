@@ -0,0 +1,585 @@
+"""
+Offline benchmark for the Flask backend.
+
+Runs the real endpoints in-process against deterministic stand-ins for yfinance,
+Cohere and MongoDB, so throughput can be measured without network access or
+credentials. Results are appended to a JSON lines file for comparison over time.
+
+    python bench.py --concurrency 8 --requests 200
+    python bench.py --scenarios stock_data,chat --upstream-latency 80 --jitter 20 --cold
+    python bench.py --scenarios chat --requests 20 --coldstart 5
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Fake upstreams
+
+class FakeLatency:
+    """Sleeps for a base latency plus seeded uniform jitter, in milliseconds"""
+
+    def __init__(self, latency_ms, jitter_ms, seed=0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            jitter = self._rng.uniform(-self.jitter, self.jitter)
+        time.sleep(max(self.latency + jitter, 0))
+
+
+def symbol_seed(symbol):
+    return int(hashlib.md5(symbol.encode()).hexdigest()[:8], 16)
+
+
+def synthetic_ohlcv(symbol, start=None, end=None, period=None, interval='1d'):
+    """Deterministic geometric random walk of business-day bars for a symbol"""
+    end = pd.Timestamp(end).tz_localize(None) if end is not None else pd.Timestamp.now().normalize()
+    if start is None:
+        start = end - pd.tseries.frequencies.to_offset({
+            '5d': '5D', '1mo': '31D', '3mo': '92D', '6mo': '183D', '1y': '366D', '2y': '731D', '5y': '1827D'
+        }.get(period, '31D'))
+    start = pd.Timestamp(start).tz_localize(None)
+    dates = pd.bdate_range(start.normalize(), end, name='Date')
+    freq = {'1wk': 'W-MON', '1mo': 'MS'}.get(interval)
+    if freq:
+        dates = pd.date_range(start.normalize(), end, freq=freq, name='Date')
+
+    # Seed by symbol and absolute day so overlapping ranges agree bar for bar
+    days = (dates - pd.Timestamp('2000-01-01')).days.to_numpy()
+    seed = symbol_seed(symbol)
+    drift = ((days * 2654435761 + seed) % 1000) / 1000 - 0.5
+    close = (50 + seed % 450) * np.exp(0.0004 * days + 0.15 * np.sin(days / (15 + seed % 40)) + 0.01 * drift)
+    spread = close * 0.01
+    return pd.DataFrame({
+        'Open': close - spread * drift,
+        'High': close + spread,
+        'Low': close - spread,
+        'Close': close,
+        'Volume': (1_000_000 + (seed % 9_000_000) * (1 + drift)).astype('int64'),
+    }, index=dates)
+
+
+class FakeTicker:
+    def __init__(self, yf, symbol):
+        self._yf = yf
+        self.ticker = symbol
+
+    def history(self, period=None, interval='1d', start=None, end=None, **kwargs):
+        self._yf.latency.wait()
+        self._yf.calls['history'] += 1
+        return synthetic_ohlcv(self.ticker, start, end, period, interval).tz_localize('America/New_York')
+
+    @property
+    def info(self):
+        self._yf.latency.wait()
+        self._yf.calls['info'] += 1
+        seed = symbol_seed(self.ticker)
+        return {
+            'longName': f'{self.ticker} Holdings',
+            'marketCap': (seed % 3000 + 50) * 1e9,
+            'sector': ['Technology', 'Financial Services', 'Healthcare', 'Consumer Defensive'][seed % 4],
+            'industry': 'Synthetic',
+            'exchange': 'NMS',
+            'forwardPE': 10 + seed % 40,
+            'dividendYield': (seed % 40) / 1000,
+            'totalAssets': (seed % 500 + 1) * 1e9,
+            'annualReportExpenseRatio': (seed % 80) / 10000,
+            'yield': (seed % 60) / 1000,
+            'categoryName': 'Intermediate Core Bond' if seed % 2 else 'Large Blend',
+            'fundFamily': 'Synthetic Funds',
+        }
+
+
+class FakeYFinance:
+    """Stand-in for the yfinance module: Ticker() and download()"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = {'history': 0, 'info': 0, 'download': 0}
+
+    def Ticker(self, symbol, session=None, proxy=None):
+        return FakeTicker(self, symbol)
+
+    def download(self, tickers, period=None, start=None, end=None, interval='1d', **kwargs):
+        self.latency.wait()
+        self.calls['download'] += 1
+        tickers = tickers.split() if isinstance(tickers, str) else list(tickers)
+        frames = {symbol: synthetic_ohlcv(symbol, start, end, period, interval) for symbol in tickers}
+        return pd.concat(frames, axis=1, names=['Ticker', 'Price'])
+
+
+class FakeCohere:
+    """Stand-in for cohere.ClientV2 with canned replies"""
+
+    def __init__(self, latency, tokens=40):
+        self.latency = latency
+        self.tokens = tokens
+
+    def rerank(self, query, documents, top_n, model):
+        self.latency.wait()
+        results = [SimpleNamespace(index=i, relevance_score=1 - i / len(documents)) for i in range(top_n)]
+        return SimpleNamespace(results=results)
+
+    def chat(self, model, messages, documents=None, **kwargs):
+        self.latency.wait()
+        text = ' '.join(['budget'] * self.tokens)
+        return SimpleNamespace(message=SimpleNamespace(content=[SimpleNamespace(text=text)]))
+
+    def chat_stream(self, model, messages, documents=None, **kwargs):
+        self.latency.wait()
+        for _ in range(self.tokens):
+            yield SimpleNamespace(type='content-delta', delta=SimpleNamespace(
+                message=SimpleNamespace(content=SimpleNamespace(text='budget '))))
+        yield SimpleNamespace(type='message-end')
+
+    def embed(self, texts, model, input_type, embedding_types, **kwargs):
+        self.latency.wait()
+        vector = np.zeros(64)
+        for word in texts[0].lower().split():
+            vector[symbol_seed(word) % 64] += 1
+        return SimpleNamespace(embeddings=SimpleNamespace(float_=[vector.tolist()]))
+
+
+class FakeCollection:
+    def __init__(self, latency):
+        self.latency = latency
+        self.documents = []
+        self.unique_keys = {}  # indexed fields -> set of values already stored
+        self._lock = threading.Lock()
+
+    def insert_one(self, document):
+        self.latency.wait()
+        with self._lock:
+            self.documents.append(dict(document))
+        return SimpleNamespace(inserted_id=len(self.documents))
+
+    def insert_many(self, documents, ordered=True, session=None):
+        from pymongo.errors import BulkWriteError
+
+        self.latency.wait()
+        errors = []
+        with self._lock:
+            for i, document in enumerate(documents):
+                keys = self._unique_values(document)
+                if any(value in self.unique_keys[fields] for fields, value in keys.items()):
+                    errors.append({'index': i, 'code': 11000, 'errmsg': 'E11000 duplicate key error'})
+                    if ordered:
+                        break
+                    continue
+                for fields, value in keys.items():
+                    self.unique_keys[fields].add(value)
+                self.documents.append(dict(document))
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'nInserted': len(documents) - len(errors)})
+        return SimpleNamespace(inserted_ids=list(range(len(documents))))
+
+    def find_one(self, query=None, *args, **kwargs):
+        self.latency.wait()
+        with self._lock:
+            return next((dict(d) for d in self.documents if matches(d, query or {})), None)
+
+    def find(self, query=None, *args, **kwargs):
+        self.latency.wait()
+        with self._lock:
+            return FakeCursor(dict(d) for d in self.documents if matches(d, query or {}))
+
+    def update_one(self, query, update, upsert=False):
+        self.latency.wait()
+        with self._lock:
+            return self._update(query, update, upsert)
+
+    def bulk_write(self, requests, ordered=True, session=None):
+        from pymongo import ReplaceOne
+
+        self.latency.wait()
+        with self._lock:
+            for request in requests:
+                if isinstance(request, ReplaceOne):
+                    self.documents = [d for d in self.documents if not matches(d, request._filter)]
+                    self.documents.append(dict(request._doc))
+                else:
+                    self._update(request._filter, request._doc, request._upsert)
+        return SimpleNamespace(bulk_api_result={})
+
+    def delete_one(self, query):
+        self.latency.wait()
+        with self._lock:
+            for i, document in enumerate(self.documents):
+                if matches(document, query):
+                    del self.documents[i]
+                    return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
+
+    def aggregate(self, pipeline, **kwargs):
+        """Supports the $match and $group stages with $sum, which is all the app uses"""
+        self.latency.wait()
+        with self._lock:
+            rows = [dict(d) for d in self.documents]
+        for stage in pipeline:
+            if '$match' in stage:
+                rows = [row for row in rows if matches(row, stage['$match'])]
+            elif '$group' in stage:
+                spec = dict(stage['$group'])
+                id_spec = spec.pop('_id')
+                groups = {}
+                for row in rows:
+                    key = {name: row.get(field[1:]) for name, field in id_spec.items()}
+                    group = groups.setdefault(tuple(key.values()), {'_id': key, **{name: 0 for name in spec}})
+                    for name, accumulator in spec.items():
+                        value = accumulator['$sum']
+                        group[name] += row.get(value[1:], 0) if isinstance(value, str) else value
+                rows = list(groups.values())
+        return iter(rows)
+
+    def create_index(self, keys, unique=False, **kwargs):
+        fields = (keys,) if isinstance(keys, str) else tuple(key for key, _ in keys)
+        if unique:
+            with self._lock:
+                self.unique_keys.setdefault(fields, set())
+        return '_'.join(fields)
+
+    def _unique_values(self, document):
+        """Values of each unique index the document takes part in (partial: all fields present)"""
+        return {fields: tuple(document[field] for field in fields) for fields in self.unique_keys
+                if all(field in document for field in fields)}
+
+    def _update(self, query, update, upsert):
+        document = next((d for d in self.documents if matches(d, query)), None)
+        if document is None:
+            if not upsert:
+                return SimpleNamespace(matched_count=0, upserted_id=None)
+            document = {key: value for key, value in query.items() if not isinstance(value, dict)}
+            self.documents.append(document)
+        for path, value in update.get('$set', {}).items():
+            parent, key = walk(document, path)
+            parent[key] = value
+        for path, value in update.get('$inc', {}).items():
+            parent, key = walk(document, path)
+            parent[key] = parent.get(key, 0) + value
+        for key, value in update.get('$addToSet', {}).items():
+            if value not in document.setdefault(key, []):
+                document[key].append(value)
+        for key, value in update.get('$pull', {}).items():
+            document[key] = [item for item in document.get(key, []) if item != value]
+        return SimpleNamespace(matched_count=1, upserted_id=None)
+
+
+class FakeCursor(list):
+    def sort(self, key, direction=1):
+        super().sort(key=lambda document: document.get(key), reverse=direction < 0)
+        return self
+
+
+def walk(document, path):
+    """Return the parent dict and final key of a dotted field path, creating levels as needed"""
+    *parents, key = path.split('.')
+    for name in parents:
+        document = document.setdefault(name, {})
+    return document, key
+
+
+def matches(document, query):
+    for key, condition in query.items():
+        value = document.get(key)
+        if isinstance(condition, dict):
+            checks = {
+                '$gte': lambda expected: value is not None and value >= expected,
+                '$lte': lambda expected: value is not None and value <= expected,
+                '$exists': lambda expected: (key in document) == expected,
+                '$in': lambda expected: value in expected,
+            }
+            if not all(checks[op](expected) for op, expected in condition.items()):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeMongo:
+    """In-memory stand-in for a pymongo Database"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection(self.latency))
+
+    @property
+    def client(self):
+        return SimpleNamespace(start_session=lambda: FakeSession())
+
+
+class FakeSession:
+    """Runs transaction callbacks directly; the fake collections never roll back"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def with_transaction(self, callback):
+        return callback(self)
+
+
+# Scenarios
+
+STOCK_SYMBOLS = ['AAPL', 'MSFT', 'NVDA', 'AMZN', 'JPM', 'KO']
+STOCK_WINDOWS = [(6, 'months'), (1, 'years'), (365, 'days'), (12, 'weeks')]
+CHAT_MESSAGES = [
+    'How do I build an emergency fund?',
+    'How to save money',
+    'What should I do about credit card debt?',
+    'How do I start investing?',
+]
+
+
+def stock_data_request(i):
+    symbol = STOCK_SYMBOLS[i % len(STOCK_SYMBOLS)]
+    size, unit = STOCK_WINDOWS[i // len(STOCK_SYMBOLS) % len(STOCK_WINDOWS)]
+    return 'GET', f'/api/stocks/all/{symbol}/?window_size={size}&window_unit={unit}', None
+
+
+def chat_request(i):
+    return 'POST', '/api/chat', {'message': CHAT_MESSAGES[i % len(CHAT_MESSAGES)]}
+
+
+def transactions_request(i):
+    rng = random.Random(i)
+    transactions = [{
+        'id': f'{i}-{n}',
+        'amount': round(rng.uniform(1, 200), 2),
+        'category': rng.choice(['Food', 'Rent', 'Transport', 'Fun', 'Bills']),
+        'date': f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+    } for n in range(50)]
+    return 'POST', f'/api/transactions/bench-{i % 10}', {'transactions': transactions}
+
+
+SCENARIOS = {
+    'stock_data': stock_data_request,
+    'top_performers': lambda i: ('GET', '/api/stocks/all/', None),
+    'top_funds': lambda i: ('GET', '/api/stocks/low-risk', None),
+    'chat': chat_request,
+    'transactions': transactions_request,
+    'watchlist_5': lambda i: ('GET', '/api/watchlist/bench-5/quotes', None),
+    'watchlist_100': lambda i: ('GET', '/api/watchlist/bench-100/quotes', None),
+}
+WATCHLIST_SYMBOLS = [f'SYM{i:03d}' for i in range(100)]
+
+
+# Runner
+
+def load_app(args):
+    """Import the app and create it against fake upstreams and an isolated bar store"""
+    os.environ.setdefault('COHERE_KEY', 'bench')
+    os.environ['BAR_STORE_DIR'] = tempfile.mkdtemp(prefix='bench-barstore-')
+    os.environ['UPSTREAM_RATE'] = str(args.upstream_rate)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as backend
+
+    upstream = FakeLatency(args.upstream_latency, args.jitter, seed=args.seed)
+    backend.yf = FakeYFinance(upstream)
+    db = FakeMongo(FakeLatency(args.mongo_latency, args.jitter, seed=args.seed + 2))
+    for size in (5, 100):
+        db['watchlists'].documents.append({'user': f'bench-{size}', 'symbols': WATCHLIST_SYMBOLS[:size]})
+    flask_app = backend.create_app({
+        'COHERE_CLIENT': FakeCohere(FakeLatency(args.cohere_latency, args.jitter, seed=args.seed + 1)),
+        'MONGO_DB': db,
+    })
+
+    if args.cold:
+        # Every request pays for the full upstream and compute path
+        for cache in backend.cache_registry.values():
+            cache.ttl = 0
+        backend.bar_store = None
+        backend.leaderboard_snapshots.interval = 0
+    return backend, flask_app
+
+
+def coldstart_child(args, import_ms):
+    """Time the first requests after a fresh import of the app"""
+    timings = {'import_ms': import_ms}
+    started = time.perf_counter()
+    backend, flask_app = load_app(args)
+    client = flask_app.test_client()
+    for name in ('chat', 'stock_data'):
+        method, url, body = SCENARIOS[name](0)
+        start = time.perf_counter()
+        client.open(url, method=method, json=body).get_data()
+        timings[f'first_{name}_ms'] = (time.perf_counter() - start) * 1000
+    timings['total_ms'] = import_ms + (time.perf_counter() - started) * 1000
+    print(json.dumps(timings))
+
+
+def run_coldstart(args):
+    """Run coldstart_child in --coldstart fresh processes and summarize each timing"""
+    # The app is imported before this file so the import time excludes the fakes' numpy/pandas
+    script = ('import time; started = time.perf_counter(); import app; '
+              'import_ms = (time.perf_counter() - started) * 1000; import bench; bench.main(import_ms=import_ms)')
+    command = [sys.executable, '-c', script, '--coldstart-child',
+               '--upstream-latency', '0', '--cohere-latency', '0', '--mongo-latency', '0', '--jitter', '0']
+    env = dict(os.environ, COHERE_KEY='bench')
+    samples = []
+    for _ in range(args.coldstart):
+        env['BAR_STORE_DIR'] = tempfile.mkdtemp(prefix='bench-barstore-')
+        output = subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        key: {
+            'p50_ms': round(float(np.percentile([sample[key] for sample in samples], 50)), 1),
+            'max_ms': round(max(sample[key] for sample in samples), 1),
+        }
+        for key in samples[0]
+    }
+
+
+def run_scenario(flask_app, name, args):
+    make_request = SCENARIOS[name]
+    clients = threading.local()
+
+    def send(i):
+        if not hasattr(clients, 'client'):
+            clients.client = flask_app.test_client()
+        method, url, body = make_request(i)
+        start = time.perf_counter()
+        response = clients.client.open(url, method=method, json=body)
+        response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(send, range(args.warmup)))
+        started = time.perf_counter()
+        samples = list(executor.map(send, range(args.requests)))
+        elapsed = time.perf_counter() - started
+
+    latencies = np.array([latency for latency, _ in samples]) * 1000
+    errors = sum(1 for _, status in samples if status >= 400)
+    return {
+        'requests': args.requests,
+        'errors': errors,
+        'requests_per_second': round(args.requests / elapsed, 2),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 2),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 2),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def previous_run(path, config):
+    """Find the most recent saved run with the same configuration"""
+    if not os.path.exists(path):
+        return None
+    match = None
+    with open(path) as f:
+        for line in f:
+            run = json.loads(line)
+            if run.get('config') == config:
+                match = run
+    return match
+
+
+def print_results(results, previous):
+    header = f"{'scenario':<16}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'rss MB':>9}"
+    print(header)
+    print('-' * len(header))
+    for name, result in results.items():
+        print(f"{name:<16}{result['requests_per_second']:>10}{result['p50_ms']:>10}{result['p95_ms']:>10}"
+              f"{result['p99_ms']:>10}{result['errors']:>8}{result['peak_rss_mb'] or '-':>9}")
+        before = (previous or {}).get('results', {}).get(name)
+        if before:
+            change = lambda key: f"{(result[key] - before[key]) / before[key] * 100:+.1f}%" if before[key] else 'n/a'
+            print(f"{'  vs ' + previous['revision'] if previous.get('revision') else '  vs previous':<16}"
+                  f"{change('requests_per_second'):>10}{change('p50_ms'):>10}{change('p95_ms'):>10}{change('p99_ms'):>10}")
+
+
+def main(import_ms=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per scenario')
+    parser.add_argument('--upstream-latency', type=float, default=50, help='fake yfinance latency in ms')
+    parser.add_argument('--cohere-latency', type=float, default=200, help='fake Cohere latency in ms')
+    parser.add_argument('--mongo-latency', type=float, default=2, help='fake MongoDB latency in ms')
+    parser.add_argument('--jitter', type=float, default=10, help='uniform +/- jitter on every fake call in ms')
+    parser.add_argument('--upstream-rate', type=float, default=0, help='upstream calls per second allowed by the app, 0 for no limit')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cold', action='store_true', help='disable caches, the bar store and snapshots')
+    parser.add_argument('--coldstart', type=int, default=0, metavar='N', help='also time import and first requests in N fresh processes')
+    parser.add_argument('--coldstart-child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_results.jsonl'))
+    args = parser.parse_args()
+    if args.coldstart_child:
+        return coldstart_child(args, import_ms)
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'scenarios', 'coldstart_child')}
+    backend, flask_app = load_app(args)
+    results = {name: run_scenario(flask_app, name, args) for name in names}
+
+    previous = previous_run(args.output, config)
+    print_results(results, previous)
+    coldstart = run_coldstart(args) if args.coldstart else None
+    if coldstart:
+        print('\nCold start (fresh process, zero fake latency)')
+        for key, values in coldstart.items():
+            print(f"  {key:<20} p50 {values['p50_ms']:>8} ms   max {values['max_ms']:>8} ms")
+
+    run = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'config': config,
+        'upstream_calls': backend.yf.calls,
+        'results': results,
+        'coldstart': coldstart,
+    }
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    print(f'\nSaved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Production server settings, used with
+
+    gunicorn app:app
+
+The app is imported and warmed up once in the master process (heavy modules, the tips
+index and the leaderboard snapshots) and then frozen out of the garbage collector, so
+forked workers share that memory copy-on-write instead of rebuilding it each.
+"""
+import gc
+import multiprocessing
+import os
+import time
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+preload_app = True
+
+
+def when_ready(server):
+    """Build shared state in the master, before any worker is forked"""
+    import app as backend
+
+    started = time.perf_counter()
+    backend.warmup(snapshots=os.environ.get('WARMUP_SNAPSHOTS', '1') == '1')
+    # Keep the warmed objects out of later collections so their pages stay shared
+    gc.collect()
+    gc.freeze()
+    server.log.info(f"Warmed up in {time.perf_counter() - started:.1f}s")
+
+
+def post_fork(server, worker):
+    import app as backend
+
+    # Workers split the Yahoo rate limit between them
+    backend.after_fork(workers=server.num_workers)
@@ -0,0 +1,88 @@
+"""
+Drive the real yfinance code through an upstream session that answers every request
+with 429, and check that the scheduler sees a throttle: run with
+
+    $ py -m pytest test_upstream.py
+"""
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+
+import app as backend
+
+
+class TooManyRequestsAdapter(HTTPAdapter):
+    """Answers every request with 429 Too Many Requests without touching the network"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        response = requests.Response()
+        response.status_code = 429
+        response.reason = 'Too Many Requests'
+        response.url = request.url
+        response.request = request
+        response._content = b'Too Many Requests'
+        return response
+
+
+@pytest.fixture
+def throttled(monkeypatch, tmp_path):
+    backend.yf.set_tz_cache_location(str(tmp_path))
+    adapter = TooManyRequestsAdapter()
+    session = backend.create_upstream_session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    monkeypatch.setattr(backend, 'upstream_session', session)
+    monkeypatch.setattr(backend, 'bar_store', None)
+    monkeypatch.setattr(backend, 'UPSTREAM_RETRIES', 1)
+    monkeypatch.setattr(backend, 'UPSTREAM_BACKOFF_BASE', 0.01)
+    monkeypatch.setattr(backend, 'UPSTREAM_BREAKER_THRESHOLD', 100)
+    monkeypatch.setattr(backend, 'upstream_scheduler', backend.UpstreamScheduler(0, 1))
+    # yfinance keeps its cookie and crumb on a process-wide singleton
+    data = backend.yf.data.YfData(session=session)
+    monkeypatch.setattr(data, '_cookie', None)
+    monkeypatch.setattr(data, '_crumb', None)
+    return adapter
+
+
+def throttled_count(stage):
+    return backend.metrics._counters[('upstream_throttled_total', (('stage', stage),))]
+
+
+def test_info_429_is_throttled(throttled):
+    before = throttled_count('yfinance_info')
+    with pytest.raises(Exception) as error:
+        backend.load_info('AAPL')
+    assert backend.is_throttled(error.value)
+    # One call plus one retry, each counted as a throttle
+    assert throttled_count('yfinance_info') - before == 2
+    assert throttled.calls >= 2
+
+
+def test_history_429_is_throttled_although_yfinance_swallows_it(throttled):
+    before = throttled_count('yfinance_history')
+    with pytest.raises(backend.UpstreamThrottled):
+        backend.load_history('AAPL', period='1mo')
+    assert throttled_count('yfinance_history') - before == 2
+
+
+def test_download_429_is_throttled(throttled):
+    before = throttled_count('yfinance_download')
+    with pytest.raises(Exception) as error:
+        backend.download_history_batch(['AAPL', 'MSFT'], '1d', period='1mo')
+    assert backend.is_throttled(error.value)
+    assert throttled_count('yfinance_download') - before == 2
+
+
+def test_repeated_429s_pause_and_open_the_breaker(throttled, monkeypatch):
+    monkeypatch.setattr(backend, 'UPSTREAM_BREAKER_THRESHOLD', 2)
+    with pytest.raises(Exception):
+        backend.load_info('MSFT')
+    stats = backend.upstream_scheduler.stats()
+    assert stats['breaker_open']
+    with pytest.raises(backend.UpstreamUnavailable):
+        backend.load_info('NVDA')
@@ -43,40 +43,22 @@ export default function Home() {
     fetchTips();
   }, [value]);
 
-  // Fetch graph data for multiple top companies
-  const fetchGraphData = async (symbol: string) => {
-    try {
-      const response = await fetch(`https://hackutd-2024-flask-server.onrender.com/api/stocks/all/${symbol}`);
-      if (response.ok) {
-        const data = await response.json();
-        return (
-          data?.data?.map((entry: any) => ({
-            date: entry.date,
-            close: entry.close,
-          })) || []
-        );
-      } else {
-        console.error(`Graph API Error for ${symbol}: ${response.status}`);
-        return [];
-      }
-    } catch (err) {
-      console.error(`Error fetching graph data for ${symbol}:`, err);
-      return [];
-    }
-  };
-
+  // Fetch the leaderboard with each top company's chart series in a single request
   useEffect(() => {
     const fetchData = async () => {
       setIsLoadingGraphs(true);
       try {
-        const response = await fetch('https://hackutd-2024-flask-server.onrender.com/api/stocks/all');
+        const response = await fetch('https://hackutd-2024-flask-server.onrender.com/api/stocks/all/?include_series=1');
         const result = await response.json();
         const topCompanies = result.data?.top_companies || [];
 
         const newGraphData: any = {};
         for (const company of topCompanies) {
-          const graph = await fetchGraphData(company.symbol);
-          newGraphData[company.symbol] = graph;
+          const series = company.series || { date: [], close: [] };
+          newGraphData[company.symbol] = series.date.map((date: string, i: number) => ({
+            date,
+            close: series.close[i],
+          }));
         }
         setGraphData(newGraphData);
       } catch (err) {